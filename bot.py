@@ -1,13 +1,33 @@
 import os
+import sys
+import argparse
+import cProfile
 import logging
+import logging.handlers
+import atexit
+import queue
+import signal
+import socket
+import subprocess
+import threading
 from dotenv import load_dotenv
 import asyncio
 import logging
+import random
+import time
 import uuid
-from datetime import datetime, date
-from typing import Dict, List, Optional
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, date, timedelta
+from typing import Any, Dict, List, Optional
 import pytz
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
 from aiogram.types import (
     ReplyKeyboardMarkup, 
     KeyboardButton, 
@@ -18,6 +38,7 @@ from aiogram.filters import Command, CommandObject
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
 import sqlite3
 import json
 
@@ -26,27 +47,285 @@ load_dotenv()
 API_TOKEN = os.getenv('BOT_TOKEN')
 TIMEZONE = os.getenv('TIMEZONE')
 DB_FILE = os.getenv('DB_FILE')
-LOG_LEVEL = os.getenv('LOG_LEVEL')
+LOG_LEVEL = os.getenv('LOG_LEVEL') or 'INFO'
 LOG_FILE = os.getenv('LOG_FILE')
 ADMIN_IDS_STR = os.getenv('ADMIN_IDS')
+ADMIN_IDS = {int(x) for x in ADMIN_IDS_STR.split(',') if x.strip()} if ADMIN_IDS_STR else set()
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
+# Настройки профилирования
+PROFILE_DIR = os.getenv('PROFILE_DIR', 'profiles')
+PROFILE_TICKS = int(os.getenv('PROFILE_TICKS', '5'))
+PROFILE_SECONDS = int(os.getenv('PROFILE_SECONDS', '30'))
+
+# Настройки HTTP-клиента и цикла событий
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '100'))
+HTTP_POOL_PER_HOST = int(os.getenv('HTTP_POOL_PER_HOST', '0'))
+HTTP_KEEPALIVE = float(os.getenv('HTTP_KEEPALIVE', '30'))
+HTTP_DNS_CACHE_TTL = int(os.getenv('HTTP_DNS_CACHE_TTL', '300'))
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '60'))
+EVENT_LOOP = os.getenv('EVENT_LOOP', 'asyncio')
+
+# Настройки хранилища: sqlite (DB_FILE) или postgres (DATABASE_URL)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'sqlite')
+DATABASE_URL = os.getenv('DATABASE_URL')
+PG_POOL_MIN = int(os.getenv('PG_POOL_MIN', '2'))
+PG_POOL_MAX = int(os.getenv('PG_POOL_MAX', '10'))
+
+# Настройки очереди доставки (outbox)
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '4'))
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '50'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '8'))
+# Аренда захваченной пачки; должна с запасом покрывать отправку всех пачек воркеров
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '120'))
+# Сколько дней хранить уведомления, снятые с доставки
+OUTBOX_FAILED_KEEP_DAYS = int(os.getenv('OUTBOX_FAILED_KEEP_DAYS', '7'))
+OUTBOX_BACKOFF_BASE = 5
+OUTBOX_BACKOFF_MAX = 3600
+
+# Пачка уведомлений минуты готовится за SCHEDULER_STAGE_AHEAD секунд до её начала
+SCHEDULER_STAGE_AHEAD = float(os.getenv('SCHEDULER_STAGE_AHEAD', '20'))
+
+# Настройки логирования: формат json или text, ротация LOG_FILE,
+# не больше LOG_RATE_LIMIT одинаковых предупреждений и ошибок за LOG_RATE_WINDOW секунд
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+LOG_RATE_LIMIT = int(os.getenv('LOG_RATE_LIMIT', '10'))
+LOG_RATE_WINDOW = float(os.getenv('LOG_RATE_WINDOW', '60'))
 
-# Токен бота
+# Токен бота; BOT_TOKENS через запятую - несколько ботов в одном процессе
 API_TOKEN = os.getenv('BOT_TOKEN')
-if not API_TOKEN:
+API_TOKENS = [t.strip() for t in (os.getenv('BOT_TOKENS') or API_TOKEN or '').split(',') if t.strip()]
+if not API_TOKENS:
     raise ValueError("BOT_TOKEN не найден! Укажите его в .env файле")
 
+# Не больше BOT_RATE_LIMIT отправок в секунду на каждого бота;
+# OUTBOUND_INTERACTIVE_RESERVE жетонов рассылка оставляет ответам пользователям
+BOT_RATE_LIMIT = float(os.getenv('BOT_RATE_LIMIT', '25'))
+OUTBOUND_INTERACTIVE_RESERVE = float(os.getenv('OUTBOUND_INTERACTIVE_RESERVE', '2'))
+
+# ========== ЛОГИРОВАНИЕ ==========
+
+# Стандартные атрибуты LogRecord; всё остальное пришло через extra
+LOG_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON; поля из extra попадают в запись как есть.
+    
+    traceback пишется в поле exc: либо из exc_info, либо подготовленный
+    QueueTracebackFormatter до того, как QueueHandler.prepare() уберёт exc_info.
+    """
+    
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, pytz.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in LOG_RECORD_ATTRS:
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+class QueueTracebackFormatter(logging.Formatter):
+    """Форматтер QueueHandler для JSON-логов: traceback не склеивается с сообщением.
+    
+    QueueHandler.prepare() заменяет msg результатом format() и убирает exc_info,
+    поэтому traceback заранее сохраняется в атрибут exc записи.
+    """
+    
+    def format(self, record: logging.LogRecord) -> str:
+        if record.exc_info:
+            record.exc = self.formatException(record.exc_info)
+        return record.getMessage()
+
+class RepeatFilter(logging.Filter):
+    """Ограничение повторяющихся предупреждений и ошибок.
+    
+    Записи группируются по логгеру, уровню и шаблону сообщения (до подстановки
+    аргументов): в окне window секунд пропускаются первые limit записей группы.
+    Первая запись следующего окна получает поле suppressed - сколько было отброшено.
+    """
+    
+    def __init__(self, limit: int, window: float):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.groups = {}
+        self.lock = threading.Lock()
+    
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.limit <= 0:
+            return True
+        
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            started, passed, suppressed = self.groups.get(key, (now, 0, 0))
+            if now - started >= self.window:
+                if suppressed:
+                    record.suppressed = suppressed
+                started, passed, suppressed = now, 0, 0
+            if passed < self.limit:
+                self.groups[key] = (started, passed + 1, suppressed)
+                return True
+            self.groups[key] = (started, passed, suppressed + 1)
+            return False
+
+def setup_logging(
+    level: str = LOG_LEVEL,
+    log_file: Optional[str] = LOG_FILE,
+    log_format: str = LOG_FORMAT
+) -> logging.handlers.QueueListener:
+    """Неблокирующее логирование.
+    
+    Цикл событий только кладёт записи в очередь; запись в stderr и в
+    ротируемый log_file выполняет фоновый поток QueueListener.
+    """
+    formatter = JsonFormatter() if log_format == 'json' else logging.Formatter(
+        '%(asctime)s %(levelname)s %(name)s: %(message)s'
+    )
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        ))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    # prepare() подставляет аргументы и traceback в сообщение ещё в вызывающем
+    # потоке: изменяемые аргументы не читаются позже из потока QueueListener
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    if log_format == 'json':
+        queue_handler.setFormatter(QueueTracebackFormatter())
+    queue_handler.addFilter(RepeatFilter(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
+    
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level.upper())
+    
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    # Дописать очередь перед выходом
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+logger = logging.getLogger(__name__)
+
+# ========== HTTP И ЦИКЛ СОБЫТИЙ ==========
+
+class PooledAiohttpSession(AiohttpSession):
+    """AiohttpSession с настройками пула соединений aiohttp.TCPConnector.
+    
+    Публичного способа передать их в коннектор у AiohttpSession нет: в aiogram
+    3.2.0 (см. requirements.txt) параметры коннектора лежат в _connector_init
+    и применяются при создании ClientSession. При обновлении aiogram проверьте,
+    что этот атрибут сохранился - это ловит tests/test_http.py.
+    """
+    
+    def __init__(self, connector: Dict[str, Any], **kwargs):
+        super().__init__(**kwargs)
+        self._connector_init.update(connector)
+
+def create_bot_session(
+    pool_size: int = HTTP_POOL_SIZE,
+    pool_per_host: int = HTTP_POOL_PER_HOST,
+    keepalive: float = HTTP_KEEPALIVE,
+    dns_cache_ttl: int = HTTP_DNS_CACHE_TTL,
+    timeout: float = HTTP_TIMEOUT,
+    api_url: Optional[str] = TELEGRAM_API_URL
+) -> AiohttpSession:
+    """HTTP-сессия бота с настроенным пулом соединений и таймаутами"""
+    api = TelegramAPIServer.from_base(api_url) if api_url else PRODUCTION
+    connector = {
+        'limit': pool_size,
+        'limit_per_host': pool_per_host,
+        'keepalive_timeout': keepalive,
+        'ttl_dns_cache': dns_cache_ttl
+    }
+    return PooledAiohttpSession(connector, api=api, timeout=timeout)
+
+def install_event_loop(name: str = EVENT_LOOP) -> str:
+    """Выбрать реализацию цикла событий. Возвращает фактически выбранную.
+    
+    uvloop - необязательная зависимость: если он не установлен,
+    используется стандартный asyncio.
+    """
+    if name == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            logger.warning("uvloop не установлен, используется стандартный цикл asyncio")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            return 'uvloop'
+    
+    asyncio.set_event_loop_policy(None)
+    return 'asyncio'
+
 # Настройки
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
-dp = Dispatcher(storage=storage)
+# Все боты используют одну HTTP-сессию и общий пул соединений;
+# каждый бот постоянно держит одно соединение под long polling
+bot_session = create_bot_session(pool_size=HTTP_POOL_SIZE + len(API_TOKENS))
+bots: Dict[int, Bot] = {b.id: b for b in (Bot(token=token, session=bot_session) for token in API_TOKENS)}
+# Основной бот: ему принадлежат события, созданные до появления bot_id
+bot = next(iter(bots.values()))
+fsm_storage = MemoryStorage()
+dp = Dispatcher(storage=fsm_storage)
 
 # Часовой пояс
 tz = pytz.timezone(TIMEZONE)
 
+# ========== ЧАСЫ ==========
+
+class Clock:
+    """Источник текущего времени для бота и планировщика"""
+    
+    def now(self) -> datetime:
+        return datetime.now(tz)
+    
+    def time(self) -> float:
+        return time.time()
+    
+    async def sleep(self, seconds: float):
+        await asyncio.sleep(seconds)
+
+class VirtualClock(Clock):
+    """Виртуальные часы: время двигается только вручную или через sleep.
+    
+    Используются в режиме воспроизведения дня, чтобы прогнать сутки
+    планировщика за секунды.
+    """
+    
+    def __init__(self, start: datetime):
+        self._now = start.astimezone(pytz.utc)
+    
+    def now(self) -> datetime:
+        return self._now.astimezone(tz)
+    
+    def time(self) -> float:
+        return self._now.timestamp()
+    
+    def set(self, moment: datetime):
+        self._now = moment.astimezone(pytz.utc)
+    
+    def advance(self, seconds: float):
+        self._now += timedelta(seconds=seconds)
+    
+    async def sleep(self, seconds: float):
+        self.advance(seconds)
+        await asyncio.sleep(0)
+
+clock = Clock()
+
 # Состояния для FSM
 class CountdownState(StatesGroup):
     waiting_for_event_name = State()
@@ -56,12 +335,16 @@ class CountdownState(StatesGroup):
 
 # ========== БАЗА ДАННЫХ ==========
 
-def init_db():
-    """Инициализация базы данных SQLite"""
+def init_db(default_bot_id: int = 0):
+    """Инициализация базы данных SQLite.
+    
+    default_bot_id - бот, которому отдаются события, созданные до появления bot_id.
+    """
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     
     # Таблица событий
+    # weekday_mask - дни недели уведомлений, бит 0 - понедельник
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS events (
         id TEXT PRIMARY KEY,
@@ -73,24 +356,315 @@ def init_db():
         is_active INTEGER DEFAULT 1,
         created_at TEXT,
         chat_type TEXT,
-        message_thread_id INTEGER DEFAULT 0
+        message_thread_id INTEGER DEFAULT 0,
+        weekday_mask INTEGER DEFAULT 127,
+        bot_id INTEGER DEFAULT 0
+    )
+    ''')
+    if not table_has_column(cursor, 'events', 'weekday_mask'):
+        cursor.execute('ALTER TABLE events ADD COLUMN weekday_mask INTEGER DEFAULT 127')
+    if not table_has_column(cursor, 'events', 'bot_id'):
+        cursor.execute('ALTER TABLE events ADD COLUMN bot_id INTEGER DEFAULT 0')
+        cursor.execute('UPDATE events SET bot_id = ?', (default_bot_id,))
+    
+    # Расписание: минуты суток, в которые событию положено уведомление.
+    # Слоты с max_days_left включаются, только когда до события осталось
+    # не больше max_days_left дней (учащение перед дедлайном): active_from
+    # хранит дату включения, у обычных слотов она минимальная.
+    # weekday_mask повторяет маску события, чтобы дни недели отсекались по индексу
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'event_slots'")
+    slots_are_new = cursor.fetchone() is None
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS event_slots (
+        minute_of_day INTEGER NOT NULL,
+        event_id TEXT NOT NULL,
+        max_days_left INTEGER,
+        active_from TEXT NOT NULL DEFAULT '0001-01-01',
+        weekday_mask INTEGER NOT NULL DEFAULT 127,
+        PRIMARY KEY (minute_of_day, event_id, max_days_left)
     )
     ''')
+    if not table_has_column(cursor, 'event_slots', 'active_from'):
+        cursor.execute("ALTER TABLE event_slots ADD COLUMN active_from TEXT NOT NULL DEFAULT '0001-01-01'")
+        cursor.execute('ALTER TABLE event_slots ADD COLUMN weekday_mask INTEGER NOT NULL DEFAULT 127')
+        cursor.execute('''
+        UPDATE event_slots SET
+            active_from = COALESCE((
+                SELECT date(e.target_date, '-' || event_slots.max_days_left || ' days')
+                FROM events e WHERE e.id = event_slots.event_id
+            ), active_from),
+            weekday_mask = COALESCE((
+                SELECT e.weekday_mask FROM events e WHERE e.id = event_slots.event_id
+            ), weekday_mask)
+        ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_event_slots_event
+    ON event_slots (event_id)
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_event_slots_due
+    ON event_slots (minute_of_day, active_from, weekday_mask)
+    ''')
+    if slots_are_new:
+        cursor.execute(f'''
+        INSERT INTO event_slots (minute_of_day, event_id)
+        SELECT {MINUTE_OF_DAY_SQL.format(column='notification_time')}, id
+        FROM events WHERE is_active = 1
+        ''')
     
     # Таблица для отслеживания отправленных уведомлений
+    sent_is_legacy = rename_legacy_table(cursor, 'sent_notifications')
     cursor.execute('''
     CREATE TABLE IF NOT EXISTS sent_notifications (
         event_id TEXT,
         notification_date TEXT,
-        PRIMARY KEY (event_id, notification_date),
+        minute_of_day INTEGER DEFAULT 0,
+        PRIMARY KEY (event_id, notification_date, minute_of_day),
         FOREIGN KEY (event_id) REFERENCES events (id)
     )
     ''')
+    if sent_is_legacy:
+        copy_legacy_table(cursor, 'sent_notifications', ['event_id', 'notification_date'])
+    
+    # Очередь исходящих уведомлений (outbox)
+    # Уникальность (event_id, notification_date, minute_of_day) защищает от повторной постановки
+    outbox_is_legacy = rename_legacy_table(cursor, 'outbox')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        event_id TEXT NOT NULL,
+        notification_date TEXT NOT NULL,
+        minute_of_day INTEGER DEFAULT 0,
+        bot_id INTEGER DEFAULT 0,
+        chat_id INTEGER NOT NULL,
+        chat_type TEXT,
+        message_thread_id INTEGER DEFAULT 0,
+        text TEXT NOT NULL,
+        scheduled_at REAL DEFAULT 0,
+        deactivate_after INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'pending',
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0,
+        claim_token TEXT,
+        claimed_until REAL DEFAULT 0,
+        last_error TEXT,
+        UNIQUE (event_id, notification_date, minute_of_day)
+    )
+    ''')
+    if outbox_is_legacy:
+        copy_legacy_table(cursor, 'outbox', [
+            'event_id', 'notification_date', 'chat_id', 'chat_type', 'message_thread_id',
+            'text', 'scheduled_at', 'deactivate_after', 'status', 'attempts',
+            'next_attempt_at', 'last_error'
+        ])
+    if not table_has_column(cursor, 'outbox', 'bot_id'):
+        cursor.execute('ALTER TABLE outbox ADD COLUMN bot_id INTEGER DEFAULT 0')
+        cursor.execute('UPDATE outbox SET bot_id = ?', (default_bot_id,))
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_outbox_pending
+    ON outbox (status, next_attempt_at)
+    ''')
+    
+    # Индекс для /stats: подсчёт и ближайшие события чата без сортировки в Python
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_events_chat_date
+    ON events (chat_id, is_active, target_date)
+    ''')
+    
+    init_counters(cursor, rebuild_minutes=slots_are_new)
     
     conn.commit()
     conn.close()
 
-init_db()
+# Перевод строки "ЧЧ:ММ" в минуту суток на стороне SQL
+MINUTE_OF_DAY_SQL = "CAST(substr({column}, 1, 2) AS INTEGER) * 60 + CAST(substr({column}, 4, 2) AS INTEGER)"
+
+def table_has_column(cursor: sqlite3.Cursor, table: str, column: str) -> bool:
+    """Проверить наличие колонки в таблице"""
+    cursor.execute(f'PRAGMA table_info({table})')
+    return any(row[1] == column for row in cursor.fetchall())
+
+def rename_legacy_table(cursor: sqlite3.Cursor, table: str) -> bool:
+    """Переименовать таблицу старого формата (без minute_of_day) в <table>_legacy"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    if cursor.fetchone() is None or table_has_column(cursor, table, 'minute_of_day'):
+        return False
+    
+    cursor.execute(f'ALTER TABLE {table} RENAME TO {table}_legacy')
+    return True
+
+def copy_legacy_table(cursor: sqlite3.Cursor, table: str, columns: List[str]):
+    """Перенести строки из <table>_legacy, вычислив minute_of_day по времени события"""
+    column_list = ', '.join(c for c in columns if table_has_column(cursor, f'{table}_legacy', c))
+    minute_sql = MINUTE_OF_DAY_SQL.format(column='events.notification_time')
+    cursor.execute(f'''
+    INSERT OR IGNORE INTO {table} ({column_list}, minute_of_day)
+    SELECT {column_list}, COALESCE((
+        SELECT {minute_sql} FROM events WHERE events.id = {table}_legacy.event_id
+    ), 0)
+    FROM {table}_legacy
+    ''')
+    cursor.execute(f'DROP TABLE {table}_legacy')
+
+def init_counters(cursor: sqlite3.Cursor, rebuild_minutes: bool = False):
+    """Таблицы счётчиков для глобальной статистики.
+    
+    Счётчики поддерживаются триггерами при каждом изменении events, event_slots
+    и sent_notifications, поэтому статистика не пересчитывается по всей БД.
+    """
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'stats_counters'")
+    is_new = cursor.fetchone() is None
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS chat_counters (
+        chat_id INTEGER PRIMARY KEY,
+        active_events INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_chat_counters_active
+    ON chat_counters (active_events)
+    ''')
+    # Количество слотов расписания на каждую минуту суток
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS minute_counters (
+        notification_time TEXT PRIMARY KEY,
+        active_events INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_sent (
+        notification_date TEXT PRIMARY KEY,
+        sent INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    
+    # Заполняем счётчики по уже существующим данным до создания триггеров
+    if is_new:
+        cursor.execute('''
+        INSERT INTO chat_counters (chat_id, active_events)
+        SELECT chat_id, COUNT(*) FROM events WHERE is_active = 1 GROUP BY chat_id
+        ''')
+        cursor.execute('''
+        INSERT INTO daily_sent (notification_date, sent)
+        SELECT notification_date, COUNT(*) FROM sent_notifications GROUP BY notification_date
+        ''')
+        cursor.execute('''
+        INSERT INTO stats_counters (name, value)
+        SELECT 'active_events', COUNT(*) FROM events WHERE is_active = 1
+        UNION ALL
+        SELECT 'active_chats', COUNT(DISTINCT chat_id) FROM events WHERE is_active = 1
+        ''')
+    if is_new or rebuild_minutes:
+        cursor.execute('DELETE FROM minute_counters')
+        cursor.execute('''
+        INSERT INTO minute_counters (notification_time, active_events)
+        SELECT printf('%02d:%02d', minute_of_day / 60, minute_of_day % 60), COUNT(*)
+        FROM event_slots GROUP BY minute_of_day
+        ''')
+    
+    # Определения триггеров пересоздаются при каждом запуске,
+    # чтобы в старых БД они совпадали с текущей версией
+    triggers = {
+        # Активное событие добавлено: учитываем его и создаём слот по notification_time
+        'trg_events_insert': f'''
+        AFTER INSERT ON events WHEN NEW.is_active = 1
+        BEGIN
+            INSERT INTO chat_counters (chat_id, active_events) VALUES (NEW.chat_id, 1)
+            ON CONFLICT (chat_id) DO UPDATE SET active_events = active_events + 1;
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'active_events';
+            INSERT OR IGNORE INTO event_slots (minute_of_day, event_id, weekday_mask)
+            VALUES ({MINUTE_OF_DAY_SQL.format(column='NEW.notification_time')}, NEW.id,
+                    COALESCE(NEW.weekday_mask, 127));
+        END
+        ''',
+        # Активное событие удалено
+        'trg_events_delete': '''
+        AFTER DELETE ON events WHEN OLD.is_active = 1
+        BEGIN
+            UPDATE chat_counters SET active_events = active_events - 1 WHERE chat_id = OLD.chat_id;
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'active_events';
+        END
+        ''',
+        # Изменение события: снимаем старое состояние и учитываем новое
+        'trg_events_update_old': '''
+        AFTER UPDATE OF is_active, chat_id ON events WHEN OLD.is_active = 1
+        BEGIN
+            UPDATE chat_counters SET active_events = active_events - 1 WHERE chat_id = OLD.chat_id;
+            UPDATE stats_counters SET value = value - 1 WHERE name = 'active_events';
+        END
+        ''',
+        'trg_events_update_new': '''
+        AFTER UPDATE OF is_active, chat_id ON events WHEN NEW.is_active = 1
+        BEGIN
+            INSERT INTO chat_counters (chat_id, active_events) VALUES (NEW.chat_id, 1)
+            ON CONFLICT (chat_id) DO UPDATE SET active_events = active_events + 1;
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'active_events';
+        END
+        ''',
+        # У неактивных событий слотов нет, поэтому выборка минуты не растёт с архивом
+        'trg_events_delete_slots': '''
+        AFTER DELETE ON events
+        BEGIN
+            DELETE FROM event_slots WHERE event_id = OLD.id;
+        END
+        ''',
+        'trg_events_deactivate_slots': '''
+        AFTER UPDATE OF is_active ON events WHEN NEW.is_active = 0
+        BEGIN
+            DELETE FROM event_slots WHERE event_id = NEW.id;
+        END
+        ''',
+        # Слоты расписания по минутам суток
+        'trg_slots_insert': '''
+        AFTER INSERT ON event_slots
+        BEGIN
+            INSERT INTO minute_counters (notification_time, active_events)
+            VALUES (printf('%02d:%02d', NEW.minute_of_day / 60, NEW.minute_of_day % 60), 1)
+            ON CONFLICT (notification_time) DO UPDATE SET active_events = active_events + 1;
+        END
+        ''',
+        'trg_slots_delete': '''
+        AFTER DELETE ON event_slots
+        BEGIN
+            UPDATE minute_counters SET active_events = active_events - 1
+            WHERE notification_time = printf('%02d:%02d', OLD.minute_of_day / 60, OLD.minute_of_day % 60);
+        END
+        ''',
+        # Количество чатов с активными событиями
+        'trg_chat_counters_insert': '''
+        AFTER INSERT ON chat_counters WHEN NEW.active_events > 0
+        BEGIN
+            UPDATE stats_counters SET value = value + 1 WHERE name = 'active_chats';
+        END
+        ''',
+        'trg_chat_counters_update': '''
+        AFTER UPDATE OF active_events ON chat_counters
+        WHEN (OLD.active_events > 0) != (NEW.active_events > 0)
+        BEGIN
+            UPDATE stats_counters
+            SET value = value + (CASE WHEN NEW.active_events > 0 THEN 1 ELSE -1 END)
+            WHERE name = 'active_chats';
+        END
+        ''',
+        # Отправленные уведомления по дням
+        'trg_sent_insert': '''
+        AFTER INSERT ON sent_notifications
+        BEGIN
+            INSERT INTO daily_sent (notification_date, sent) VALUES (NEW.notification_date, 1)
+            ON CONFLICT (notification_date) DO UPDATE SET sent = sent + 1;
+        END
+        '''
+    }
+    for name, body in triggers.items():
+        cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cursor.execute(f'CREATE TRIGGER {name} {body}')
 
 def save_event(event_data: dict) -> str:
     """Сохранить событие в БД"""
@@ -101,8 +675,8 @@ def save_event(event_data: dict) -> str:
     cursor.execute('''
     INSERT INTO events 
     (id, chat_id, user_id, event_name, target_date, notification_time, 
-     is_active, created_at, chat_type, message_thread_id)
-    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+     is_active, created_at, chat_type, message_thread_id, bot_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
     ''', (
         event_id,
         event_data['chat_id'],
@@ -113,24 +687,56 @@ def save_event(event_data: dict) -> str:
         1,
         datetime.now().isoformat(),
         event_data.get('chat_type', 'private'),
-        event_data.get('message_thread_id', 0)
+        event_data.get('message_thread_id', 0),
+        event_data.get('bot_id', 0)
     ))
     
     conn.commit()
     conn.close()
     return event_id
 
-def get_chat_events(chat_id: int) -> List[dict]:
-    """Получить все события для чата"""
+def insert_events(events: List[dict]) -> int:
+    """Массовая вставка событий с готовыми id одной транзакцией"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.executemany('''
+    INSERT INTO events 
+    (id, chat_id, user_id, event_name, target_date, notification_time, 
+     is_active, created_at, chat_type, message_thread_id, bot_id)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [
+        (
+            e['id'],
+            e['chat_id'],
+            e['user_id'],
+            e['event_name'],
+            e['target_date'].isoformat(),
+            e['notification_time'],
+            1,
+            e.get('created_at', ''),
+            e.get('chat_type', 'private'),
+            e.get('message_thread_id', 0),
+            e.get('bot_id', 0)
+        )
+        for e in events
+    ])
+    
+    conn.commit()
+    conn.close()
+    return len(events)
+
+def get_chat_events(chat_id: int, bot_id: Optional[int] = None) -> List[dict]:
+    """Получить все события для чата (bot_id=None - всех ботов)"""
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     
     cursor.execute('''
     SELECT id, user_id, event_name, target_date, notification_time, is_active
     FROM events 
-    WHERE chat_id = ? AND is_active = 1
+    WHERE chat_id = ? AND is_active = 1 AND (? IS NULL OR bot_id = ?)
     ORDER BY target_date
-    ''', (chat_id,))
+    ''', (chat_id, bot_id, bot_id))
     
     events = []
     for row in cursor.fetchall():
@@ -146,7 +752,7 @@ def get_chat_events(chat_id: int) -> List[dict]:
     conn.close()
     return events
 
-def get_user_events_in_chat(chat_id: int, user_id: int) -> List[dict]:
+def get_user_events_in_chat(chat_id: int, user_id: int, bot_id: Optional[int] = None) -> List[dict]:
     """Получить события пользователя в конкретном чате"""
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
@@ -154,9 +760,9 @@ def get_user_events_in_chat(chat_id: int, user_id: int) -> List[dict]:
     cursor.execute('''
     SELECT id, event_name, target_date, notification_time
     FROM events 
-    WHERE chat_id = ? AND user_id = ? AND is_active = 1
+    WHERE chat_id = ? AND user_id = ? AND is_active = 1 AND (? IS NULL OR bot_id = ?)
     ORDER BY target_date
-    ''', (chat_id, user_id))
+    ''', (chat_id, user_id, bot_id, bot_id))
     
     events = []
     for row in cursor.fetchall():
@@ -170,6 +776,22 @@ def get_user_events_in_chat(chat_id: int, user_id: int) -> List[dict]:
     conn.close()
     return events
 
+def find_user_event(event_id_short: str, user_id: int, chat_id: int, bot_id: Optional[int] = None) -> Optional[dict]:
+    """Найти активное событие пользователя в чате по началу ID"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    SELECT id, event_name FROM events 
+    WHERE id LIKE ? AND user_id = ? AND chat_id = ? AND is_active = 1 AND (? IS NULL OR bot_id = ?)
+    ''', (f"{event_id_short.rstrip('.')}%", user_id, chat_id, bot_id, bot_id))
+    
+    result = cursor.fetchone()
+    conn.close()
+    if result is None:
+        return None
+    return {'id': result[0], 'event_name': result[1]}
+
 def delete_event(event_id: str, user_id: int = None):
     """Удалить событие"""
     conn = sqlite3.connect(DB_FILE)
@@ -187,6 +809,11 @@ def delete_event(event_id: str, user_id: int = None):
     
     # Удаляем связанные уведомления
     cursor.execute('DELETE FROM sent_notifications WHERE event_id = ?', (event_id,))
+    # и подготовленные заранее, если событие действительно удалено
+    cursor.execute('''
+    DELETE FROM outbox
+    WHERE event_id = ? AND status = 'pending' AND NOT EXISTS (SELECT 1 FROM events WHERE id = ?)
+    ''', (event_id, event_id))
     
     conn.commit()
     conn.close()
@@ -201,74 +828,1450 @@ def deactivate_event(event_id: str):
     SET is_active = 0 
     WHERE id = ?
     ''', (event_id,))
+    # Неотправленные уведомления события больше не нужны
+    cursor.execute("DELETE FROM outbox WHERE event_id = ? AND status = 'pending'", (event_id,))
+    
+    conn.commit()
+    conn.close()
+
+def deactivate_past_events(today: date) -> int:
+    """Деактивировать все события, дата которых уже прошла"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    UPDATE events 
+    SET is_active = 0 
+    WHERE is_active = 1 AND target_date < ?
+    ''', (today.isoformat(),))
+    deactivated = cursor.rowcount
+    
+    conn.commit()
+    conn.close()
+    return deactivated
+
+def mark_notification_sent(event_id: str, notification_date: date, minute_of_day: int = 0):
+    """Отметить, что уведомление было отправлено"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    INSERT OR IGNORE INTO sent_notifications (event_id, notification_date, minute_of_day)
+    VALUES (?, ?, ?)
+    ''', (event_id, notification_date.isoformat(), minute_of_day))
+    
+    conn.commit()
+    conn.close()
+
+def was_notification_sent_today(event_id: str) -> bool:
+    """Проверить, отправлялось ли уведомление сегодня"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    today = clock.now().date().isoformat()
+    cursor.execute('''
+    SELECT 1 FROM sent_notifications 
+    WHERE event_id = ? AND notification_date = ?
+    ''', (event_id, today))
+    
+    result = cursor.fetchone() is not None
+    conn.close()
+    return result
+
+def get_due_events(now: datetime) -> List[dict]:
+    """События, у которых есть слот расписания на минуту now.
+    
+    Выборка идёт по индексу event_slots (минута, active_from, дни недели),
+    поэтому её стоимость зависит от числа слотов, действующих сегодня в эту
+    минуту, а не от размера БД и не от будущих учащений.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    today = now.date()
+    cursor.execute('''
+    SELECT DISTINCT e.id, e.chat_id, e.event_name, e.target_date, e.notification_time,
+           e.user_id, e.chat_type, e.message_thread_id,
+           NOT EXISTS (
+               SELECT 1 FROM event_slots later
+               WHERE later.event_id = e.id AND later.minute_of_day > s.minute_of_day
+           ),
+           e.bot_id
+    FROM event_slots s
+    JOIN events e ON e.id = s.event_id
+    WHERE s.minute_of_day = ?
+      AND s.active_from <= ?
+      AND (s.weekday_mask & ?) != 0
+      AND e.is_active = 1
+    ''', (now.hour * 60 + now.minute, today.isoformat(), 1 << today.weekday()))
+    
+    events = []
+    for row in cursor.fetchall():
+        events.append({
+            'id': row[0],
+            'chat_id': row[1],
+            'event_name': row[2],
+            'target_date': datetime.strptime(row[3], '%Y-%m-%d').date(),
+            'notification_time': row[4],
+            'user_id': row[5],
+            'chat_type': row[6],
+            'message_thread_id': row[7],
+            'last_slot': bool(row[8]),
+            'bot_id': row[9]
+        })
+    
+    conn.close()
+    return events
+
+def get_event_schedules(event_ids: List[str]) -> Dict[str, dict]:
+    """Прочитать расписания нескольких событий одним запросом"""
+    if not event_ids:
+        return {}
+    
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    placeholders = ', '.join('?' * len(event_ids))
+    cursor.execute(f'SELECT id, weekday_mask FROM events WHERE id IN ({placeholders})', event_ids)
+    masks = dict(cursor.fetchall())
+    
+    cursor.execute(f'''
+    SELECT event_id, minute_of_day, max_days_left FROM event_slots
+    WHERE event_id IN ({placeholders})
+    ORDER BY minute_of_day
+    ''', event_ids)
+    slots = {}
+    for event_id, minute_of_day, max_days_left in cursor.fetchall():
+        slots.setdefault(event_id, []).append((minute_of_day, max_days_left))
+    
+    conn.close()
+    return {
+        event_id: build_schedule(masks.get(event_id), slots.get(event_id, []))
+        for event_id in event_ids
+    }
+
+def get_event_schedule(event_id: str) -> dict:
+    """Прочитать расписание события"""
+    return get_event_schedules([event_id])[event_id]
+
+def set_event_schedule(event_id: str, schedule: dict):
+    """Заменить расписание события.
+    
+    notification_time остаётся равным первому слоту расписания.
+    """
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT target_date FROM events WHERE id = ?', (event_id,))
+    row = cursor.fetchone()
+    if row is None:
+        conn.close()
+        return
+    rows = [
+        (minute_of_day, event_id, max_days_left, active_from.isoformat(), weekday_mask)
+        for minute_of_day, event_id, max_days_left, active_from, weekday_mask
+        in schedule_slot_rows(event_id, datetime.strptime(row[0], '%Y-%m-%d').date(), schedule)
+    ]
+    
+    cursor.execute('''
+    UPDATE events SET weekday_mask = ?, notification_time = ?
+    WHERE id = ?
+    ''', (schedule['weekday_mask'], format_minute_of_day(min(schedule['slots'])), event_id))
+    cursor.execute('DELETE FROM event_slots WHERE event_id = ?', (event_id,))
+    cursor.executemany('''
+    INSERT OR IGNORE INTO event_slots (minute_of_day, event_id, max_days_left, active_from, weekday_mask)
+    VALUES (?, ?, ?, ?, ?)
+    ''', rows)
+    # Подготовленные заранее по старому расписанию
+    cursor.execute('''
+    DELETE FROM outbox WHERE event_id = ? AND status = 'pending' AND scheduled_at > ?
+    ''', (event_id, clock.time()))
     
     conn.commit()
     conn.close()
 
-def get_all_active_events():
-    """Получить все активные события"""
+def get_chat_stats(chat_id: int, today: date, bot_id: Optional[int] = None) -> dict:
+    """Статистика чата: количество отсчётов и три ближайших события"""
     conn = sqlite3.connect(DB_FILE)
     cursor = conn.cursor()
     
     cursor.execute('''
-    SELECT id, chat_id, event_name, target_date, notification_time, 
-           user_id, chat_type, message_thread_id
+    SELECT COUNT(*), COALESCE(SUM(target_date >= ?), 0)
     FROM events 
-    WHERE is_active = 1
-    ''')
+    WHERE chat_id = ? AND is_active = 1 AND (? IS NULL OR bot_id = ?)
+    ''', (today.isoformat(), chat_id, bot_id, bot_id))
+    total_events, upcoming_events = cursor.fetchone()
+    
+    cursor.execute('''
+    SELECT event_name, target_date
+    FROM events 
+    WHERE chat_id = ? AND is_active = 1 AND (? IS NULL OR bot_id = ?) AND target_date >= ?
+    ORDER BY target_date
+    LIMIT 3
+    ''', (chat_id, bot_id, bot_id, today.isoformat()))
+    
+    closest_events = []
+    for row in cursor.fetchall():
+        closest_events.append({
+            'event_name': row[0],
+            'target_date': datetime.strptime(row[1], '%Y-%m-%d').date()
+        })
+    
+    conn.close()
+    return {
+        'total_events': total_events,
+        'upcoming_events': upcoming_events,
+        'closest_events': closest_events
+    }
+
+def get_global_stats(days: int = 7, top: int = 5) -> dict:
+    """Глобальная статистика по таблицам счётчиков"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('SELECT name, value FROM stats_counters')
+    counters = dict(cursor.fetchall())
+    
+    cursor.execute('''
+    SELECT chat_id, active_events FROM chat_counters
+    WHERE active_events > 0
+    ORDER BY active_events DESC
+    LIMIT ?
+    ''', (top,))
+    top_chats = cursor.fetchall()
+    
+    cursor.execute('''
+    SELECT notification_time, active_events FROM minute_counters
+    WHERE active_events > 0
+    ORDER BY active_events DESC
+    LIMIT ?
+    ''', (top * 2,))
+    busiest_minutes = cursor.fetchall()
+    
+    cursor.execute('''
+    SELECT notification_date, sent FROM daily_sent
+    ORDER BY notification_date DESC
+    LIMIT ?
+    ''', (days,))
+    sent_per_day = cursor.fetchall()
+    
+    conn.close()
+    return {
+        'active_events': counters.get('active_events', 0),
+        'active_chats': counters.get('active_chats', 0),
+        'top_chats': top_chats,
+        'busiest_minutes': busiest_minutes,
+        'sent_per_day': sent_per_day
+    }
+
+# ========== ОЧЕРЕДЬ ДОСТАВКИ ==========
+
+def enqueue_notifications(notifications: List[dict]) -> int:
+    """Поставить уведомления в очередь одной транзакцией.
+    
+    Уже отправленные и уже стоящие в очереди уведомления пропускаются.
+    Возвращает количество добавленных записей.
+    """
+    if not notifications:
+        return 0
+    
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    before = conn.total_changes
+    cursor.executemany('''
+    INSERT OR IGNORE INTO outbox
+    (event_id, notification_date, minute_of_day, bot_id, chat_id, chat_type, message_thread_id,
+     text, scheduled_at, deactivate_after, next_attempt_at)
+    SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
+    WHERE NOT EXISTS (
+        SELECT 1 FROM sent_notifications
+        WHERE event_id = ? AND notification_date = ? AND minute_of_day = ?
+    )
+    ''', [
+        (
+            n['event_id'],
+            n['notification_date'].isoformat(),
+            n.get('minute_of_day', 0),
+            n.get('bot_id', 0),
+            n['chat_id'],
+            n.get('chat_type', 'private'),
+            n.get('message_thread_id', 0),
+            n['text'],
+            n.get('scheduled_at', clock.time()),
+            int(n.get('deactivate_after', False)),
+            # Подготовленная заранее пачка станет доступна воркерам в свою минуту
+            n.get('scheduled_at', clock.time()),
+            n['event_id'],
+            n['notification_date'].isoformat(),
+            n.get('minute_of_day', 0)
+        )
+        for n in notifications
+    ])
+    added = conn.total_changes - before
+    
+    conn.commit()
+    conn.close()
+    return added
+
+def claim_outbox_batch(limit: int, lease_seconds: int = OUTBOX_LEASE_SECONDS) -> List[dict]:
+    """Захватить пачку готовых к отправке уведомлений.
+    
+    Захват выполняется одним UPDATE, поэтому два воркера не получат одну запись.
+    Если воркер упал, запись вернётся в очередь по истечении аренды.
+    """
+    now = clock.time()
+    token = str(uuid.uuid4())
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    UPDATE outbox
+    SET claim_token = ?, claimed_until = ?
+    WHERE id IN (
+        SELECT id FROM outbox
+        WHERE status = 'pending' AND next_attempt_at <= ? AND claimed_until <= ?
+        ORDER BY next_attempt_at
+        LIMIT ?
+    )
+    ''', (token, now + lease_seconds, now, now, limit))
+    conn.commit()
+    
+    cursor.execute('''
+    SELECT id, event_id, notification_date, minute_of_day, chat_id, chat_type,
+           message_thread_id, text, scheduled_at, deactivate_after, attempts, bot_id,
+           claim_token, claimed_until
+    FROM outbox
+    WHERE claim_token = ?
+    ''', (token,))
+    
+    batch = []
+    for row in cursor.fetchall():
+        batch.append({
+            'id': row[0],
+            'event_id': row[1],
+            'notification_date': row[2],
+            'minute_of_day': row[3],
+            'chat_id': row[4],
+            'chat_type': row[5],
+            'message_thread_id': row[6],
+            'text': row[7],
+            'scheduled_at': row[8],
+            'deactivate_after': bool(row[9]),
+            'attempts': row[10],
+            'bot_id': row[11],
+            'claim_token': row[12],
+            'claimed_until': row[13]
+        })
+    
+    conn.close()
+    return batch
+
+def ack_outbox(items: List[dict]):
+    """Подтвердить доставку: отметить отправку и убрать записи из очереди.
+    
+    Подтверждаются только записи, которые всё ещё захвачены этим воркером
+    (claim_token): если аренда истекла и запись захватил другой воркер,
+    отправку отметит он.
+    """
+    if not items:
+        return
+    
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    acked = []
+    for item in items:
+        cursor.execute(
+            'DELETE FROM outbox WHERE id = ? AND claim_token = ?',
+            (item['id'], item['claim_token'])
+        )
+        if cursor.rowcount:
+            acked.append(item)
+    
+    cursor.executemany('''
+    INSERT OR IGNORE INTO sent_notifications (event_id, notification_date, minute_of_day)
+    VALUES (?, ?, ?)
+    ''', [(item['event_id'], item['notification_date'], item['minute_of_day']) for item in acked])
+    
+    # Если событие сегодня, деактивируем после отправки
+    cursor.executemany('''
+    UPDATE events SET is_active = 0 WHERE id = ?
+    ''', [(item['event_id'],) for item in acked if item['deactivate_after']])
+    
+    conn.commit()
+    conn.close()
+
+def retry_outbox(
+    item: dict, error: str, delay: Optional[float] = None, count_attempt: bool = True
+) -> Optional[str]:
+    """Вернуть уведомление в очередь с экспоненциальной задержкой.
+    
+    После OUTBOX_MAX_ATTEMPTS попыток запись помечается как 'failed'.
+    Возвращает новый статус записи или None, если запись уже захвачена
+    другим воркером (аренда истекла) и осталась без изменений.
+    count_attempt=False - отправка не начиналась (бот на паузе), попытка не считается.
+    """
+    attempts = item['attempts'] + 1 if count_attempt else item['attempts']
+    if delay is None:
+        delay = min(OUTBOX_BACKOFF_BASE * 2 ** item['attempts'], OUTBOX_BACKOFF_MAX)
+    status = 'failed' if attempts >= OUTBOX_MAX_ATTEMPTS else 'pending'
+    
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    UPDATE outbox
+    SET status = ?, attempts = ?, next_attempt_at = ?,
+        claim_token = NULL, claimed_until = 0, last_error = ?
+    WHERE id = ? AND claim_token = ?
+    ''', (status, attempts, clock.time() + delay, error[:500], item['id'], item['claim_token']))
+    updated = cursor.rowcount
+    
+    conn.commit()
+    conn.close()
+    return status if updated else None
+
+def fail_outbox(item: dict, error: str):
+    """Снять уведомление с доставки без повторных попыток"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    UPDATE outbox
+    SET status = 'failed', attempts = attempts + 1,
+        claim_token = NULL, claimed_until = 0, last_error = ?
+    WHERE id = ? AND claim_token = ?
+    ''', (error[:500], item['id'], item['claim_token']))
+    
+    conn.commit()
+    conn.close()
+
+def purge_outbox(before: float) -> int:
+    """Удалить снятые с доставки уведомления, запланированные раньше before"""
+    conn = sqlite3.connect(DB_FILE)
+    cursor = conn.cursor()
+    
+    cursor.execute('''
+    DELETE FROM outbox WHERE status = 'failed' AND scheduled_at < ?
+    ''', (before,))
+    purged = cursor.rowcount
+    
+    conn.commit()
+    conn.close()
+    return purged
+
+def check_outbox_settings():
+    """Проверить, что аренды пачки хватает на её отправку.
+    
+    Все воркеры могут захватить пачки одного бота; тогда последний жетон будет
+    выдан через OUTBOX_WORKERS * OUTBOX_BATCH_SIZE / BOT_RATE_LIMIT секунд, а сам
+    запрос может идти до HTTP_TIMEOUT. deliver_batch не начинает отправку, которая
+    не успеет до конца аренды, поэтому при короткой аренде пачки просто
+    возвращались бы в очередь, не отправляясь.
+    """
+    token_wait = OUTBOX_WORKERS * OUTBOX_BATCH_SIZE / BOT_RATE_LIMIT
+    required = 2 * token_wait + HTTP_TIMEOUT
+    if OUTBOX_LEASE_SECONDS < required:
+        raise ValueError(
+            f"Слишком короткая аренда OUTBOX_LEASE_SECONDS={OUTBOX_LEASE_SECONDS:g}: жетоны на "
+            f"{OUTBOX_WORKERS} пачек по {OUTBOX_BATCH_SIZE} при BOT_RATE_LIMIT={BOT_RATE_LIMIT:g} "
+            f"выдаются до {token_wait:g} с, запрос идёт до HTTP_TIMEOUT={HTTP_TIMEOUT:g} с, "
+            f"нужно не меньше {required:g} с"
+        )
+
+# ========== ХРАНИЛИЩЕ ==========
+
+class Storage(ABC):
+    """Интерфейс хранилища событий, отметок об отправке и очереди доставки.
+    
+    Все методы асинхронные, чтобы сетевые бэкенды не блокировали цикл событий.
+    """
+    
+    @abstractmethod
+    async def init(self, default_bot_id: int = 0):
+        """Создать схему и подключения.
+        
+        default_bot_id - бот, которому отдаются события, созданные до появления bot_id.
+        """
+    
+    async def close(self):
+        """Закрыть подключения"""
+    
+    @abstractmethod
+    async def save_event(self, event_data: dict) -> str:
+        """Сохранить новое событие, вернуть его id"""
+    
+    @abstractmethod
+    async def insert_events(self, events: List[dict]) -> int:
+        """Массовая вставка событий с готовыми id"""
+    
+    @abstractmethod
+    async def get_chat_events(self, chat_id: int, bot_id: Optional[int] = None) -> List[dict]:
+        """Активные события чата по дате"""
+    
+    @abstractmethod
+    async def get_user_events_in_chat(self, chat_id: int, user_id: int, bot_id: Optional[int] = None) -> List[dict]:
+        """Активные события пользователя в чате"""
+    
+    @abstractmethod
+    async def find_user_event(
+        self, event_id_short: str, user_id: int, chat_id: int, bot_id: Optional[int] = None
+    ) -> Optional[dict]:
+        """Событие пользователя в чате по началу id"""
+    
+    @abstractmethod
+    async def delete_event(self, event_id: str, user_id: int = None):
+        """Удалить событие; с user_id - только событие этого пользователя"""
+    
+    @abstractmethod
+    async def deactivate_event(self, event_id: str):
+        """Снять событие с уведомлений"""
+    
+    @abstractmethod
+    async def deactivate_past_events(self, today: date) -> int:
+        """Снять события, дата которых раньше today; вернуть их количество"""
+    
+    @abstractmethod
+    async def get_due_events(self, now: datetime) -> List[dict]:
+        """События, у которых есть слот расписания на минуту now"""
+    
+    @abstractmethod
+    async def get_event_schedule(self, event_id: str) -> dict:
+        """Расписание события"""
+    
+    @abstractmethod
+    async def get_event_schedules(self, event_ids: List[str]) -> Dict[str, dict]:
+        """Расписания нескольких событий: {id: расписание}"""
+    
+    @abstractmethod
+    async def set_event_schedule(self, event_id: str, schedule: dict):
+        """Заменить расписание события"""
+    
+    @abstractmethod
+    async def mark_notification_sent(self, event_id: str, notification_date: date, minute_of_day: int = 0):
+        """Отметить, что уведомление было отправлено"""
+    
+    @abstractmethod
+    async def was_notification_sent_today(self, event_id: str) -> bool:
+        """Отправлялось ли уведомление сегодня"""
+    
+    @abstractmethod
+    async def get_chat_stats(self, chat_id: int, today: date, bot_id: Optional[int] = None) -> dict:
+        """Статистика чата"""
+    
+    @abstractmethod
+    async def get_global_stats(self, days: int = 7, top: int = 5) -> dict:
+        """Общая статистика для администраторов"""
+    
+    @abstractmethod
+    async def enqueue_notifications(self, notifications: List[dict]) -> int:
+        """Поставить уведомления в outbox без дублей; вернуть число добавленных"""
+    
+    @abstractmethod
+    async def claim_outbox_batch(self, limit: int, lease_seconds: int = OUTBOX_LEASE_SECONDS) -> List[dict]:
+        """Захватить пачку готовых к отправке уведомлений на lease_seconds"""
+    
+    @abstractmethod
+    async def ack_outbox(self, items: List[dict]):
+        """Подтвердить доставку захваченных уведомлений"""
+    
+    @abstractmethod
+    async def retry_outbox(
+        self, item: dict, error: str, delay: Optional[float] = None, count_attempt: bool = True
+    ) -> Optional[str]:
+        """Вернуть в очередь; count_attempt=False - не расходуя попытку.
+        
+        Возвращает новый статус или None, если запись захвачена другим воркером.
+        """
+    
+    @abstractmethod
+    async def fail_outbox(self, item: dict, error: str):
+        """Снять уведомление с доставки без повторных попыток"""
+    
+    @abstractmethod
+    async def purge_outbox(self, before: float) -> int:
+        """Удалить снятые с доставки уведомления, запланированные раньше before"""
+
+class SQLiteStorage(Storage):
+    """Хранилище в файле SQLite (DB_FILE). Обёртка над функциями выше.
+    
+    Функции блокирующие, поэтому выполняются в пуле потоков через asyncio.to_thread.
+    """
+    
+    async def init(self, default_bot_id: int = 0):
+        await asyncio.to_thread(init_db, default_bot_id)
+    
+    async def save_event(self, event_data: dict) -> str:
+        return await asyncio.to_thread(save_event, event_data)
+    
+    async def insert_events(self, events: List[dict]) -> int:
+        return await asyncio.to_thread(insert_events, events)
+    
+    async def get_chat_events(self, chat_id: int, bot_id: Optional[int] = None) -> List[dict]:
+        return await asyncio.to_thread(get_chat_events, chat_id, bot_id)
+    
+    async def get_user_events_in_chat(self, chat_id: int, user_id: int, bot_id: Optional[int] = None) -> List[dict]:
+        return await asyncio.to_thread(get_user_events_in_chat, chat_id, user_id, bot_id)
+    
+    async def find_user_event(
+        self, event_id_short: str, user_id: int, chat_id: int, bot_id: Optional[int] = None
+    ) -> Optional[dict]:
+        return await asyncio.to_thread(find_user_event, event_id_short, user_id, chat_id, bot_id)
+    
+    async def delete_event(self, event_id: str, user_id: int = None):
+        await asyncio.to_thread(delete_event, event_id, user_id)
+    
+    async def deactivate_event(self, event_id: str):
+        await asyncio.to_thread(deactivate_event, event_id)
+    
+    async def deactivate_past_events(self, today: date) -> int:
+        return await asyncio.to_thread(deactivate_past_events, today)
+    
+    async def get_due_events(self, now: datetime) -> List[dict]:
+        return await asyncio.to_thread(get_due_events, now)
+    
+    async def get_event_schedule(self, event_id: str) -> dict:
+        return await asyncio.to_thread(get_event_schedule, event_id)
+    
+    async def get_event_schedules(self, event_ids: List[str]) -> Dict[str, dict]:
+        return await asyncio.to_thread(get_event_schedules, event_ids)
+    
+    async def set_event_schedule(self, event_id: str, schedule: dict):
+        await asyncio.to_thread(set_event_schedule, event_id, schedule)
+    
+    async def mark_notification_sent(self, event_id: str, notification_date: date, minute_of_day: int = 0):
+        await asyncio.to_thread(mark_notification_sent, event_id, notification_date, minute_of_day)
+    
+    async def was_notification_sent_today(self, event_id: str) -> bool:
+        return await asyncio.to_thread(was_notification_sent_today, event_id)
+    
+    async def get_chat_stats(self, chat_id: int, today: date, bot_id: Optional[int] = None) -> dict:
+        return await asyncio.to_thread(get_chat_stats, chat_id, today, bot_id)
+    
+    async def get_global_stats(self, days: int = 7, top: int = 5) -> dict:
+        return await asyncio.to_thread(get_global_stats, days, top)
+    
+    async def enqueue_notifications(self, notifications: List[dict]) -> int:
+        return await asyncio.to_thread(enqueue_notifications, notifications)
+    
+    async def claim_outbox_batch(self, limit: int, lease_seconds: int = OUTBOX_LEASE_SECONDS) -> List[dict]:
+        return await asyncio.to_thread(claim_outbox_batch, limit, lease_seconds)
+    
+    async def ack_outbox(self, items: List[dict]):
+        await asyncio.to_thread(ack_outbox, items)
+    
+    async def retry_outbox(
+        self, item: dict, error: str, delay: Optional[float] = None, count_attempt: bool = True
+    ) -> Optional[str]:
+        return await asyncio.to_thread(retry_outbox, item, error, delay, count_attempt)
+    
+    async def fail_outbox(self, item: dict, error: str):
+        await asyncio.to_thread(fail_outbox, item, error)
+    
+    async def purge_outbox(self, before: float) -> int:
+        return await asyncio.to_thread(purge_outbox, before)
+
+# ========== POSTGRESQL ==========
+
+POSTGRES_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS events (
+    id TEXT PRIMARY KEY,
+    chat_id BIGINT,
+    user_id BIGINT,
+    event_name TEXT NOT NULL,
+    target_date DATE NOT NULL,
+    notification_time TEXT NOT NULL,
+    is_active BOOLEAN DEFAULT TRUE,
+    created_at TEXT,
+    chat_type TEXT,
+    message_thread_id BIGINT DEFAULT 0,
+    weekday_mask INTEGER DEFAULT 127,
+    bot_id BIGINT DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_events_chat_date ON events (chat_id, is_active, target_date);
+
+CREATE TABLE IF NOT EXISTS event_slots (
+    minute_of_day SMALLINT NOT NULL,
+    event_id TEXT NOT NULL,
+    max_days_left INTEGER,
+    active_from DATE NOT NULL DEFAULT '0001-01-01',
+    weekday_mask INTEGER NOT NULL DEFAULT 127,
+    UNIQUE (minute_of_day, event_id, max_days_left)
+);
+CREATE INDEX IF NOT EXISTS idx_event_slots_event ON event_slots (event_id);
+CREATE INDEX IF NOT EXISTS idx_event_slots_due ON event_slots (minute_of_day, active_from, weekday_mask);
+
+CREATE TABLE IF NOT EXISTS sent_notifications (
+    event_id TEXT,
+    notification_date DATE,
+    minute_of_day SMALLINT DEFAULT 0,
+    PRIMARY KEY (event_id, notification_date, minute_of_day)
+);
+
+CREATE TABLE IF NOT EXISTS outbox (
+    id BIGSERIAL PRIMARY KEY,
+    event_id TEXT NOT NULL,
+    notification_date DATE NOT NULL,
+    minute_of_day SMALLINT DEFAULT 0,
+    bot_id BIGINT DEFAULT 0,
+    chat_id BIGINT NOT NULL,
+    chat_type TEXT,
+    message_thread_id BIGINT DEFAULT 0,
+    text TEXT NOT NULL,
+    scheduled_at DOUBLE PRECISION DEFAULT 0,
+    deactivate_after BOOLEAN DEFAULT FALSE,
+    status TEXT DEFAULT 'pending',
+    attempts INTEGER DEFAULT 0,
+    next_attempt_at DOUBLE PRECISION DEFAULT 0,
+    claim_token TEXT,
+    claimed_until DOUBLE PRECISION DEFAULT 0,
+    last_error TEXT,
+    UNIQUE (event_id, notification_date, minute_of_day)
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_pending ON outbox (status, next_attempt_at);
+
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chat_counters (
+    chat_id BIGINT PRIMARY KEY,
+    active_events INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_chat_counters_active ON chat_counters (active_events);
+CREATE TABLE IF NOT EXISTS minute_counters (
+    notification_time TEXT PRIMARY KEY,
+    active_events INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS daily_sent (
+    notification_date DATE PRIMARY KEY,
+    sent INTEGER NOT NULL DEFAULT 0
+);
+INSERT INTO stats_counters (name, value) VALUES ('active_events', 0), ('active_chats', 0)
+ON CONFLICT (name) DO NOTHING;
+
+-- Счётчики и слоты поддерживаются триггерами так же, как в SQLite
+CREATE OR REPLACE FUNCTION events_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.is_active THEN
+        UPDATE chat_counters SET active_events = active_events - 1 WHERE chat_id = OLD.chat_id;
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'active_events';
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.is_active THEN
+        INSERT INTO chat_counters (chat_id, active_events) VALUES (NEW.chat_id, 1)
+        ON CONFLICT (chat_id) DO UPDATE SET active_events = chat_counters.active_events + 1;
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'active_events';
+    END IF;
+    IF TG_OP = 'INSERT' AND NEW.is_active THEN
+        INSERT INTO event_slots (minute_of_day, event_id, weekday_mask)
+        VALUES (substr(NEW.notification_time, 1, 2)::int * 60 + substr(NEW.notification_time, 4, 2)::int, NEW.id,
+                COALESCE(NEW.weekday_mask, 127))
+        ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP = 'DELETE' OR (TG_OP = 'UPDATE' AND NOT NEW.is_active) THEN
+        DELETE FROM event_slots WHERE event_id = OLD.id;
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_events_counters ON events;
+CREATE TRIGGER trg_events_counters
+AFTER INSERT OR DELETE OR UPDATE OF is_active, chat_id ON events
+FOR EACH ROW EXECUTE FUNCTION events_counters();
+
+CREATE OR REPLACE FUNCTION slots_counters() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO minute_counters (notification_time, active_events)
+        VALUES (to_char(NEW.minute_of_day / 60, 'FM00') || ':' || to_char(NEW.minute_of_day % 60, 'FM00'), 1)
+        ON CONFLICT (notification_time) DO UPDATE SET active_events = minute_counters.active_events + 1;
+    ELSE
+        UPDATE minute_counters SET active_events = active_events - 1
+        WHERE notification_time = to_char(OLD.minute_of_day / 60, 'FM00') || ':' || to_char(OLD.minute_of_day % 60, 'FM00');
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_slots_counters ON event_slots;
+CREATE TRIGGER trg_slots_counters
+AFTER INSERT OR DELETE ON event_slots
+FOR EACH ROW EXECUTE FUNCTION slots_counters();
+
+CREATE OR REPLACE FUNCTION chat_counters_active() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' AND NEW.active_events > 0 THEN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'active_chats';
+    ELSIF TG_OP = 'UPDATE' AND (OLD.active_events > 0) <> (NEW.active_events > 0) THEN
+        UPDATE stats_counters
+        SET value = value + (CASE WHEN NEW.active_events > 0 THEN 1 ELSE -1 END)
+        WHERE name = 'active_chats';
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_chat_counters ON chat_counters;
+CREATE TRIGGER trg_chat_counters
+AFTER INSERT OR UPDATE OF active_events ON chat_counters
+FOR EACH ROW EXECUTE FUNCTION chat_counters_active();
+
+CREATE OR REPLACE FUNCTION sent_counters() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO daily_sent (notification_date, sent) VALUES (NEW.notification_date, 1)
+    ON CONFLICT (notification_date) DO UPDATE SET sent = daily_sent.sent + 1;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_sent_counters ON sent_notifications;
+CREATE TRIGGER trg_sent_counters
+AFTER INSERT ON sent_notifications
+FOR EACH ROW EXECUTE FUNCTION sent_counters();
+'''
+
+def event_from_record(record) -> dict:
+    """Преобразовать строку asyncpg в словарь события"""
+    event = dict(record)
+    if 'is_active' in event:
+        event['is_active'] = bool(event['is_active'])
+    return event
+
+class PostgresStorage(Storage):
+    """Хранилище в PostgreSQL через пул соединений asyncpg.
+    
+    Массовые операции выполняются через COPY и unnest, захват очереди -
+    через FOR UPDATE SKIP LOCKED, поэтому несколько процессов могут
+    разбирать outbox одновременно.
+    """
+    
+    def __init__(self, dsn: str, min_size: int = 2, max_size: int = 10):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+    
+    async def init(self, default_bot_id: int = 0):
+        try:
+            import asyncpg
+        except ImportError:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres установите asyncpg")
+        
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        async with self.pool.acquire() as conn:
+            # Схема создаётся под блокировкой, чтобы несколько процессов не мешали друг другу
+            async with conn.transaction():
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('timer_bot_schema'))")
+                # Слоты до появления active_from: даты включения считаются по событиям
+                outdated = await conn.fetchval('''
+                SELECT to_regclass('event_slots') IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM information_schema.columns
+                    WHERE table_name = 'event_slots' AND column_name = 'active_from'
+                )
+                ''')
+                if outdated:
+                    await conn.execute('''
+                    ALTER TABLE event_slots
+                        ADD COLUMN active_from DATE NOT NULL DEFAULT '0001-01-01',
+                        ADD COLUMN weekday_mask INTEGER NOT NULL DEFAULT 127;
+                    UPDATE event_slots s
+                    SET active_from = COALESCE(e.target_date - s.max_days_left, s.active_from),
+                        weekday_mask = e.weekday_mask
+                    FROM events e
+                    WHERE e.id = s.event_id;
+                    ''')
+                await conn.execute(POSTGRES_SCHEMA)
+                # Схемы до появления bot_id: события отдаются основному боту
+                for table in ('events', 'outbox'):
+                    added = await conn.fetchval('''
+                    SELECT NOT EXISTS (
+                        SELECT 1 FROM information_schema.columns
+                        WHERE table_name = $1 AND column_name = 'bot_id'
+                    )
+                    ''', table)
+                    if added:
+                        await conn.execute(f'ALTER TABLE {table} ADD COLUMN bot_id BIGINT DEFAULT 0')
+                        await conn.execute(f'UPDATE {table} SET bot_id = $1', default_bot_id)
+    
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+    
+    async def save_event(self, event_data: dict) -> str:
+        event_id = str(uuid.uuid4())
+        await self.pool.execute('''
+        INSERT INTO events 
+        (id, chat_id, user_id, event_name, target_date, notification_time, 
+         is_active, created_at, chat_type, message_thread_id, bot_id)
+        VALUES ($1, $2, $3, $4, $5, $6, TRUE, $7, $8, $9, $10)
+        ''',
+            event_id,
+            event_data['chat_id'],
+            event_data['user_id'],
+            event_data['event_name'],
+            event_data['target_date'],
+            event_data['notification_time'],
+            datetime.now().isoformat(),
+            event_data.get('chat_type', 'private'),
+            event_data.get('message_thread_id', 0),
+            event_data.get('bot_id', 0)
+        )
+        return event_id
+    
+    async def insert_events(self, events: List[dict]) -> int:
+        async with self.pool.acquire() as conn:
+            await conn.copy_records_to_table(
+                'events',
+                columns=[
+                    'id', 'chat_id', 'user_id', 'event_name', 'target_date', 'notification_time',
+                    'is_active', 'created_at', 'chat_type', 'message_thread_id', 'bot_id'
+                ],
+                records=[
+                    (
+                        e['id'], e['chat_id'], e['user_id'], e['event_name'], e['target_date'],
+                        e['notification_time'], True, e.get('created_at', ''),
+                        e.get('chat_type', 'private'), e.get('message_thread_id', 0), e.get('bot_id', 0)
+                    )
+                    for e in events
+                ]
+            )
+            # После массовой загрузки обновляем статистику планировщика запросов
+            await conn.execute('ANALYZE events, event_slots')
+        return len(events)
+    
+    async def get_chat_events(self, chat_id: int, bot_id: Optional[int] = None) -> List[dict]:
+        rows = await self.pool.fetch('''
+        SELECT id, user_id, event_name, target_date, notification_time, is_active
+        FROM events 
+        WHERE chat_id = $1 AND is_active AND ($2::bigint IS NULL OR bot_id = $2)
+        ORDER BY target_date
+        ''', chat_id, bot_id)
+        return [event_from_record(row) for row in rows]
+    
+    async def get_user_events_in_chat(self, chat_id: int, user_id: int, bot_id: Optional[int] = None) -> List[dict]:
+        rows = await self.pool.fetch('''
+        SELECT id, event_name, target_date, notification_time
+        FROM events 
+        WHERE chat_id = $1 AND user_id = $2 AND is_active AND ($3::bigint IS NULL OR bot_id = $3)
+        ORDER BY target_date
+        ''', chat_id, user_id, bot_id)
+        return [event_from_record(row) for row in rows]
+    
+    async def find_user_event(
+        self, event_id_short: str, user_id: int, chat_id: int, bot_id: Optional[int] = None
+    ) -> Optional[dict]:
+        row = await self.pool.fetchrow('''
+        SELECT id, event_name FROM events 
+        WHERE id LIKE $1 AND user_id = $2 AND chat_id = $3 AND is_active
+          AND ($4::bigint IS NULL OR bot_id = $4)
+        LIMIT 1
+        ''', f"{event_id_short.rstrip('.')}%", user_id, chat_id, bot_id)
+        return dict(row) if row else None
+    
+    async def delete_event(self, event_id: str, user_id: int = None):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                if user_id:
+                    # Удаляем только если пользователь создавал
+                    await conn.execute('DELETE FROM events WHERE id = $1 AND user_id = $2', event_id, user_id)
+                else:
+                    await conn.execute('DELETE FROM events WHERE id = $1', event_id)
+                await conn.execute('DELETE FROM sent_notifications WHERE event_id = $1', event_id)
+                await conn.execute('''
+                DELETE FROM outbox
+                WHERE event_id = $1 AND status = 'pending' AND NOT EXISTS (SELECT 1 FROM events WHERE id = $1)
+                ''', event_id)
+    
+    async def deactivate_event(self, event_id: str):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('UPDATE events SET is_active = FALSE WHERE id = $1', event_id)
+                await conn.execute("DELETE FROM outbox WHERE event_id = $1 AND status = 'pending'", event_id)
+    
+    async def deactivate_past_events(self, today: date) -> int:
+        status = await self.pool.execute('''
+        UPDATE events SET is_active = FALSE
+        WHERE is_active AND target_date < $1
+        ''', today)
+        return int(status.split()[-1])
+    
+    async def get_due_events(self, now: datetime) -> List[dict]:
+        today = now.date()
+        rows = await self.pool.fetch('''
+        SELECT DISTINCT e.id, e.chat_id, e.event_name, e.target_date, e.notification_time,
+               e.user_id, e.chat_type, e.message_thread_id,
+               NOT EXISTS (
+                   SELECT 1 FROM event_slots later
+                   WHERE later.event_id = e.id AND later.minute_of_day > s.minute_of_day
+               ) AS last_slot,
+               e.bot_id
+        FROM event_slots s
+        JOIN events e ON e.id = s.event_id
+        WHERE s.minute_of_day = $1
+          AND s.active_from <= $2
+          AND (s.weekday_mask & $3) <> 0
+          AND e.is_active
+        ''', now.hour * 60 + now.minute, today, 1 << today.weekday())
+        return [event_from_record(row) for row in rows]
+    
+    async def get_event_schedule(self, event_id: str) -> dict:
+        return (await self.get_event_schedules([event_id]))[event_id]
+    
+    async def get_event_schedules(self, event_ids: List[str]) -> Dict[str, dict]:
+        if not event_ids:
+            return {}
+        async with self.pool.acquire() as conn:
+            masks = dict(await conn.fetch(
+                'SELECT id, weekday_mask FROM events WHERE id = ANY($1::text[])', event_ids
+            ))
+            rows = await conn.fetch('''
+            SELECT event_id, minute_of_day, max_days_left FROM event_slots
+            WHERE event_id = ANY($1::text[])
+            ORDER BY minute_of_day
+            ''', event_ids)
+        
+        slots = {}
+        for row in rows:
+            slots.setdefault(row['event_id'], []).append((row['minute_of_day'], row['max_days_left']))
+        return {
+            event_id: build_schedule(masks.get(event_id), slots.get(event_id, []))
+            for event_id in event_ids
+        }
     
-    events = []
-    for row in cursor.fetchall():
-        events.append({
-            'id': row[0],
-            'chat_id': row[1],
-            'event_name': row[2],
-            'target_date': datetime.strptime(row[3], '%Y-%m-%d').date(),
-            'notification_time': row[4],
-            'user_id': row[5],
-            'chat_type': row[6],
-            'message_thread_id': row[7]
-        })
+    async def set_event_schedule(self, event_id: str, schedule: dict):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                target_date = await conn.fetchval('SELECT target_date FROM events WHERE id = $1', event_id)
+                if target_date is None:
+                    return
+                rows = schedule_slot_rows(event_id, target_date, schedule)
+                await conn.execute('''
+                UPDATE events SET weekday_mask = $1, notification_time = $2
+                WHERE id = $3
+                ''', schedule['weekday_mask'], format_minute_of_day(min(schedule['slots'])), event_id)
+                await conn.execute('DELETE FROM event_slots WHERE event_id = $1', event_id)
+                await conn.executemany('''
+                INSERT INTO event_slots (minute_of_day, event_id, max_days_left, active_from, weekday_mask)
+                VALUES ($1, $2, $3, $4, $5)
+                ON CONFLICT DO NOTHING
+                ''', rows)
+                await conn.execute('''
+                DELETE FROM outbox WHERE event_id = $1 AND status = 'pending' AND scheduled_at > $2
+                ''', event_id, clock.time())
+    
+    async def mark_notification_sent(self, event_id: str, notification_date: date, minute_of_day: int = 0):
+        await self.pool.execute('''
+        INSERT INTO sent_notifications (event_id, notification_date, minute_of_day)
+        VALUES ($1, $2, $3)
+        ON CONFLICT DO NOTHING
+        ''', event_id, notification_date, minute_of_day)
+    
+    async def was_notification_sent_today(self, event_id: str) -> bool:
+        return await self.pool.fetchval('''
+        SELECT EXISTS (
+            SELECT 1 FROM sent_notifications 
+            WHERE event_id = $1 AND notification_date = $2
+        )
+        ''', event_id, clock.now().date())
+    
+    async def get_chat_stats(self, chat_id: int, today: date, bot_id: Optional[int] = None) -> dict:
+        async with self.pool.acquire() as conn:
+            counts = await conn.fetchrow('''
+            SELECT COUNT(*) AS total_events,
+                   COUNT(*) FILTER (WHERE target_date >= $2) AS upcoming_events
+            FROM events 
+            WHERE chat_id = $1 AND is_active AND ($3::bigint IS NULL OR bot_id = $3)
+            ''', chat_id, today, bot_id)
+            rows = await conn.fetch('''
+            SELECT event_name, target_date
+            FROM events 
+            WHERE chat_id = $1 AND is_active AND ($3::bigint IS NULL OR bot_id = $3) AND target_date >= $2
+            ORDER BY target_date
+            LIMIT 3
+            ''', chat_id, today, bot_id)
+        return {
+            'total_events': counts['total_events'],
+            'upcoming_events': counts['upcoming_events'],
+            'closest_events': [dict(row) for row in rows]
+        }
     
-    conn.close()
-    return events
-
-def mark_notification_sent(event_id: str, notification_date: date):
-    """Отметить, что уведомление было отправлено"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+    async def get_global_stats(self, days: int = 7, top: int = 5) -> dict:
+        async with self.pool.acquire() as conn:
+            counters = dict(await conn.fetch('SELECT name, value FROM stats_counters'))
+            top_chats = await conn.fetch('''
+            SELECT chat_id, active_events FROM chat_counters
+            WHERE active_events > 0
+            ORDER BY active_events DESC
+            LIMIT $1
+            ''', top)
+            busiest_minutes = await conn.fetch('''
+            SELECT notification_time, active_events FROM minute_counters
+            WHERE active_events > 0
+            ORDER BY active_events DESC
+            LIMIT $1
+            ''', top * 2)
+            sent_per_day = await conn.fetch('''
+            SELECT notification_date::text, sent FROM daily_sent
+            ORDER BY notification_date DESC
+            LIMIT $1
+            ''', days)
+        return {
+            'active_events': counters.get('active_events', 0),
+            'active_chats': counters.get('active_chats', 0),
+            'top_chats': [tuple(row) for row in top_chats],
+            'busiest_minutes': [tuple(row) for row in busiest_minutes],
+            'sent_per_day': [tuple(row) for row in sent_per_day]
+        }
     
-    cursor.execute('''
-    INSERT OR IGNORE INTO sent_notifications (event_id, notification_date)
-    VALUES (?, ?)
-    ''', (event_id, notification_date.isoformat()))
+    async def enqueue_notifications(self, notifications: List[dict]) -> int:
+        if not notifications:
+            return 0
+        
+        # Одна вставка на всю пачку: столбцы передаются массивами
+        columns = list(zip(*[
+            (
+                n['event_id'],
+                n['notification_date'],
+                n.get('minute_of_day', 0),
+                n.get('bot_id', 0),
+                n['chat_id'],
+                n.get('chat_type', 'private'),
+                n.get('message_thread_id', 0),
+                n['text'],
+                n.get('scheduled_at', clock.time()),
+                bool(n.get('deactivate_after', False))
+            )
+            for n in notifications
+        ]))
+        status = await self.pool.execute('''
+        INSERT INTO outbox
+        (event_id, notification_date, minute_of_day, bot_id, chat_id, chat_type, message_thread_id,
+         text, scheduled_at, deactivate_after, next_attempt_at)
+        SELECT n.*, n.scheduled_at
+        FROM unnest($1::text[], $2::date[], $3::smallint[], $4::bigint[], $5::bigint[], $6::text[],
+                    $7::bigint[], $8::text[], $9::double precision[], $10::boolean[])
+             AS n (event_id, notification_date, minute_of_day, bot_id, chat_id, chat_type,
+                   message_thread_id, text, scheduled_at, deactivate_after)
+        WHERE NOT EXISTS (
+            SELECT 1 FROM sent_notifications s
+            WHERE s.event_id = n.event_id AND s.notification_date = n.notification_date
+              AND s.minute_of_day = n.minute_of_day
+        )
+        ON CONFLICT DO NOTHING
+        ''', *columns)
+        return int(status.split()[-1])
+    
+    async def claim_outbox_batch(self, limit: int, lease_seconds: int = OUTBOX_LEASE_SECONDS) -> List[dict]:
+        now = clock.time()
+        rows = await self.pool.fetch('''
+        UPDATE outbox
+        SET claim_token = $1, claimed_until = $2
+        WHERE id IN (
+            SELECT id FROM outbox
+            WHERE status = 'pending' AND next_attempt_at <= $3 AND claimed_until <= $3
+            ORDER BY next_attempt_at
+            LIMIT $4
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, event_id, notification_date, minute_of_day, chat_id, chat_type,
+                  message_thread_id, text, scheduled_at, deactivate_after, attempts, bot_id,
+                  claim_token, claimed_until
+        ''', str(uuid.uuid4()), now + lease_seconds, now, limit)
+        return [dict(row) for row in rows]
+    
+    async def ack_outbox(self, items: List[dict]):
+        if not items:
+            return
+        
+        # Подтверждаются только записи, которые всё ещё захвачены этим воркером
+        await self.pool.execute('''
+        WITH acked AS (
+            DELETE FROM outbox o
+            USING unnest($1::bigint[], $2::text[]) AS a (id, claim_token)
+            WHERE o.id = a.id AND o.claim_token = a.claim_token
+            RETURNING o.event_id, o.notification_date, o.minute_of_day, o.deactivate_after
+        ), sent AS (
+            INSERT INTO sent_notifications (event_id, notification_date, minute_of_day)
+            SELECT event_id, notification_date, minute_of_day FROM acked
+            ON CONFLICT DO NOTHING
+        )
+        -- Если событие сегодня, деактивируем после отправки
+        UPDATE events SET is_active = FALSE
+        WHERE id IN (SELECT event_id FROM acked WHERE deactivate_after)
+        ''',
+            [item['id'] for item in items],
+            [item['claim_token'] for item in items]
+        )
     
-    conn.commit()
-    conn.close()
+    async def retry_outbox(
+        self, item: dict, error: str, delay: Optional[float] = None, count_attempt: bool = True
+    ) -> Optional[str]:
+        attempts = item['attempts'] + 1 if count_attempt else item['attempts']
+        if delay is None:
+            delay = min(OUTBOX_BACKOFF_BASE * 2 ** item['attempts'], OUTBOX_BACKOFF_MAX)
+        status = 'failed' if attempts >= OUTBOX_MAX_ATTEMPTS else 'pending'
+        
+        result = await self.pool.execute('''
+        UPDATE outbox
+        SET status = $1, attempts = $2, next_attempt_at = $3,
+            claim_token = NULL, claimed_until = 0, last_error = $4
+        WHERE id = $5 AND claim_token = $6
+        ''', status, attempts, clock.time() + delay, error[:500], item['id'], item['claim_token'])
+        return status if int(result.split()[-1]) else None
+    
+    async def fail_outbox(self, item: dict, error: str):
+        await self.pool.execute('''
+        UPDATE outbox
+        SET status = 'failed', attempts = attempts + 1,
+            claim_token = NULL, claimed_until = 0, last_error = $1
+        WHERE id = $2 AND claim_token = $3
+        ''', error[:500], item['id'], item['claim_token'])
+    
+    async def purge_outbox(self, before: float) -> int:
+        status = await self.pool.execute('''
+        DELETE FROM outbox WHERE status = 'failed' AND scheduled_at < $1
+        ''', before)
+        return int(status.split()[-1])
 
-def was_notification_sent_today(event_id: str) -> bool:
-    """Проверить, отправлялось ли уведомление сегодня"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    
-    today = datetime.now(tz).date().isoformat()
-    cursor.execute('''
-    SELECT 1 FROM sent_notifications 
-    WHERE event_id = ? AND notification_date = ?
-    ''', (event_id, today))
+def create_storage(backend: str = STORAGE_BACKEND, dsn: Optional[str] = DATABASE_URL) -> Storage:
+    """Создать хранилище по имени бэкенда"""
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend == 'postgres':
+        if not dsn:
+            raise ValueError("DATABASE_URL не указан! Укажите его в .env файле")
+        return PostgresStorage(dsn, PG_POOL_MIN, PG_POOL_MAX)
+    raise ValueError(f"Неизвестный STORAGE_BACKEND: {backend}")
+
+storage = create_storage()
+
+# ========== ПРОФИЛИРОВАНИЕ ==========
+
+# Состояние профилировщика; пока профилирование выключено,
+# планировщик лишь сравнивает счётчик с нулём
+profiling = {
+    'ticks_left': 0,
+    'tick_profile': None,
+    'tick_stages': [],
+    'window_profile': None
+}
+
+# Этапы тика планировщика: снятие прошедших и очистка очереди, выборка,
+# рендер текстов, запись в очередь (вместе со снятием просроченных событий)
+TICK_STAGES = ('cleanup', 'select', 'render', 'enqueue')
+
+def dump_profile(profile: cProfile.Profile, kind: str) -> str:
+    """Сохранить профиль в PROFILE_DIR в формате pstats"""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{kind}-{clock.now().strftime('%Y%m%d-%H%M%S')}.pstats")
+    profile.dump_stats(path)
+    logger.info("Профиль сохранён: %s", path)
+    return path
+
+def dump_tick_stages(ticks: List[dict], pstats_path: str) -> str:
+    """Сохранить время этапов тиков рядом с профилем: по строке на тик и итог"""
+    path = pstats_path[:-len('.pstats')] + '-stages.txt'
+    totals = {stage: sum(stages.get(stage, 0) for stages in ticks) for stage in TICK_STAGES}
+    lines = [
+        "Время этапов тиков планировщика, мс (по часам, включая ожидание БД)",
+        f"{'тик':<6}" + "".join(f"{stage:>12}" for stage in TICK_STAGES)
+    ]
+    for i, stages in enumerate(ticks + [totals], 1):
+        label = i if i <= len(ticks) else 'всего'
+        lines.append(f"{label:<6}" + "".join(f"{1000 * stages.get(stage, 0):>12.1f}" for stage in TICK_STAGES))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("\n".join(lines) + "\n")
+    logger.info("Этапы тиков сохранены: %s", path)
+    return path
+
+def start_tick_profiling(ticks: int = PROFILE_TICKS):
+    """Профилировать следующие ticks тиков планировщика.
+    
+    cProfile включается только на рендер - синхронную часть тика. Запросы к БД
+    выполняются в потоках (SQLite) или на сервере (PostgreSQL), а пока тик ждёт
+    их, цикл событий выполняет чужие задачи, поэтому этапы с БД замеряются по
+    часам и сохраняются рядом с профилем в файл *-stages.txt.
+    """
+    profiling['ticks_left'] = ticks
+    logger.info("Профилирование следующих тиков планировщика: %s", ticks)
+
+def start_window_profiling(seconds: int = PROFILE_SECONDS) -> bool:
+    """Профилировать всё, что выполняется в цикле событий, следующие seconds секунд.
+    
+    Время в потоках asyncio.to_thread (запросы SQLite) в профиль не попадает.
+    Возвращает False, если профилирование уже запущено.
+    """
+    if profiling['window_profile'] is not None or profiling['tick_profile'] is not None:
+        return False
+    
+    profile = cProfile.Profile()
+    profiling['window_profile'] = profile
+    profile.enable()
+    
+    def stop():
+        profile.disable()
+        profiling['window_profile'] = None
+        dump_profile(profile, "handlers")
+    
+    asyncio.get_running_loop().call_later(seconds, stop)
+    logger.info("Профилирование цикла событий на %s с", seconds)
+    return True
+
+async def profiled_scheduler_tick(now: Optional[datetime] = None) -> int:
+    """Тик планировщика с профилированием, если оно запрошено"""
+    # Окно профилирования уже захватывает тики целиком
+    if not profiling['ticks_left'] or profiling['window_profile'] is not None:
+        return await scheduler_tick(now)
+    
+    if profiling['tick_profile'] is None:
+        profiling['tick_profile'] = cProfile.Profile()
+        profiling['tick_stages'] = []
+    profile = profiling['tick_profile']
+    
+    stages = {}
+    try:
+        return await scheduler_tick(now, profile, stages)
+    finally:
+        profiling['tick_stages'].append(stages)
+        profiling['ticks_left'] -= 1
+        if not profiling['ticks_left']:
+            profiling['tick_profile'] = None
+            dump_tick_stages(profiling['tick_stages'], dump_profile(profile, "ticks"))
+
+def install_profiling_signals():
+    """SIGUSR1 профилирует тики планировщика, SIGUSR2 - окно в PROFILE_SECONDS секунд"""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
     
-    result = cursor.fetchone() is not None
-    conn.close()
-    return result
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, start_tick_profiling)
+    loop.add_signal_handler(signal.SIGUSR2, start_window_profiling)
 
 # ========== УТИЛИТЫ ==========
 
 def days_until_target(target_date: date, current_date: Optional[date] = None) -> int:
     """Рассчитать количество дней до даты"""
     if current_date is None:
-        current_date = datetime.now(tz).date()
+        current_date = clock.now().date()
     return (target_date - current_date).days
 
+# Расписание: бит 0 маски - понедельник
+WEEKDAY_NAMES = ['пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс']
+ALL_WEEKDAYS = 0b1111111
+WORKDAYS = 0b0011111
+WEEKENDS = 0b1100000
+MAX_SCHEDULE_SLOTS = 24
+# active_from обычных слотов: действуют всегда
+ALWAYS_ACTIVE = date.min
+
+def parse_minute_of_day(time_str: str) -> int:
+    """Перевести строку ЧЧ:ММ в минуту суток"""
+    time_obj = datetime.strptime(time_str.strip(), "%H:%M")
+    return time_obj.hour * 60 + time_obj.minute
+
+def format_minute_of_day(minute_of_day: int) -> str:
+    """Перевести минуту суток в строку ЧЧ:ММ"""
+    return f"{minute_of_day // 60:02d}:{minute_of_day % 60:02d}"
+
+def parse_weekdays(spec: str) -> int:
+    """Разобрать дни недели: будни, выходные, все, пн-пт, пт-пн или пн,ср,пт"""
+    presets = {'все': ALL_WEEKDAYS, 'будни': WORKDAYS, 'выходные': WEEKENDS}
+    if spec in presets:
+        return presets[spec]
+    
+    mask = 0
+    for part in spec.split(','):
+        if '-' in part:
+            first, last = (WEEKDAY_NAMES.index(day) for day in part.split('-', 1))
+            # Диапазон через воскресенье: пт-пн - пятница, выходные и понедельник
+            for day in range(first, last + 1 if last >= first else last + 8):
+                mask |= 1 << (day % 7)
+        else:
+            mask |= 1 << WEEKDAY_NAMES.index(part)
+    return mask
+
+def parse_schedule(spec: str, current: dict) -> dict:
+    """Разобрать расписание вида "дни=будни время=09:00,18:00 за7=12:00".
+    
+    за<N>=... - дополнительные уведомления, когда до события не больше N дней.
+    Не указанные части берутся из current. При ошибке - ValueError.
+    """
+    schedule = {
+        'weekday_mask': current['weekday_mask'],
+        'slots': current['slots'],
+        'escalation': []
+    }
+    escalation = dict(current['escalation'])
+    
+    for token in spec.lower().split():
+        key, _, value = token.partition('=')
+        if not value:
+            raise ValueError(token)
+        if key == 'дни':
+            schedule['weekday_mask'] = parse_weekdays(value)
+        elif key == 'время':
+            schedule['slots'] = sorted({parse_minute_of_day(t) for t in value.split(',')})
+        elif key.startswith('за') and key[2:].isdigit():
+            if value == 'нет':
+                escalation.pop(int(key[2:]), None)
+            else:
+                escalation[int(key[2:])] = sorted({parse_minute_of_day(t) for t in value.split(',')})
+        else:
+            raise ValueError(token)
+    
+    schedule['escalation'] = sorted(escalation.items(), reverse=True)
+    total_slots = len(schedule['slots']) + sum(len(m) for _, m in schedule['escalation'])
+    if not schedule['weekday_mask'] or not schedule['slots'] or total_slots > MAX_SCHEDULE_SLOTS:
+        raise ValueError(spec)
+    return schedule
+
+def build_schedule(weekday_mask: Optional[int], slots: List[tuple]) -> dict:
+    """Собрать расписание из строк event_slots (minute_of_day, max_days_left)"""
+    regular = []
+    escalation = {}
+    for minute_of_day, max_days_left in slots:
+        if max_days_left is None:
+            regular.append(minute_of_day)
+        else:
+            escalation.setdefault(max_days_left, []).append(minute_of_day)
+    return {
+        'weekday_mask': weekday_mask if weekday_mask is not None else ALL_WEEKDAYS,
+        'slots': regular,
+        'escalation': sorted(escalation.items(), reverse=True)
+    }
+
+def schedule_slot_rows(event_id: str, target_date: date, schedule: dict) -> List[tuple]:
+    """Строки event_slots для расписания события.
+    
+    (minute_of_day, event_id, max_days_left, active_from, weekday_mask):
+    слот учащения включается за max_days_left дней до target_date.
+    """
+    mask = schedule['weekday_mask']
+    rows = [(minute_of_day, event_id, None, ALWAYS_ACTIVE, mask) for minute_of_day in schedule['slots']]
+    for max_days_left, minutes in schedule['escalation']:
+        active_from = target_date - timedelta(days=max_days_left)
+        rows.extend((minute_of_day, event_id, max_days_left, active_from, mask) for minute_of_day in minutes)
+    return rows
+
+def describe_schedule(schedule: dict) -> str:
+    """Описание расписания для пользователя"""
+    mask = schedule['weekday_mask']
+    if mask == ALL_WEEKDAYS:
+        days = "ежедневно"
+    elif mask == WORKDAYS:
+        days = "по будням"
+    elif mask == WEEKENDS:
+        days = "по выходным"
+    else:
+        days = ", ".join(name for i, name in enumerate(WEEKDAY_NAMES) if mask & (1 << i))
+    
+    text = f"{days} в {', '.join(format_minute_of_day(m) for m in schedule['slots'])}"
+    for max_days_left, minutes in schedule['escalation']:
+        text += f"\nза {max_days_left} дн. и меньше - ещё в {', '.join(format_minute_of_day(m) for m in minutes)}"
+    return text
+
 def format_countdown_message(event_name: str, days_left: int, target_date: date) -> str:
     """Форматировать сообщение с отсчётом"""
     if days_left > 0:
@@ -315,12 +2318,12 @@ def format_countdown_message(event_name: str, days_left: int, target_date: date)
             day_word = "дней"
         return f" **{event_name}**\nСобытие прошло **{past_days} {day_word}** назад\n{target_date.strftime('%d.%m.%Y')}"
 
-def format_events_list(events: List[dict]) -> str:
-    """Форматировать список событий"""
+def format_events_list(events: List[dict], schedules: Dict[str, dict]) -> str:
+    """Форматировать список событий с их расписаниями"""
     if not events:
         return " Нет активных отсчётов"
     
-    today = datetime.now(tz).date()
+    today = clock.now().date()
     message = "**Активные отсчёты:**\n\n"
     
     for i, event in enumerate(events, 1):
@@ -335,7 +2338,7 @@ def format_events_list(events: List[dict]) -> str:
         
         message += f"{i}. **{event['event_name']}**\n"
         message += f"{event['target_date'].strftime('%d.%m.%Y')}\n"
-        message += f"Уведомления в {event['notification_time']}\n"
+        message += f"Уведомления: {describe_schedule(schedules[event['id']])}\n"
         message += f"Осталось: {days_left} {day_word}\n"
         
         # Индикатор прогресса
@@ -354,7 +2357,7 @@ async def cmd_start(message: types.Message):
     """Команда /start"""
     welcome_text = (
         "**Бот для обратного отсчёта**\n\n"
-        "Я могу вести обратный отсчёт до важных событий и ежедневно отправлять уведомления.\n\n"
+        "Я могу вести обратный отсчёт до важных событий и присылать уведомления по расписанию.\n\n"
         "**Работает в:**\n"
         "• Личных сообщениях\n"
         "• Групповых чатах\n"
@@ -365,9 +2368,11 @@ async def cmd_start(message: types.Message):
         "• /list - показать все отсчёты в чате\n"
         "• /my - мои отсчёты в этом чате\n"
         "• /delete - удалить отсчёт\n"
+        "• /schedule - расписание уведомлений\n"
         "• /help - справка\n\n"
         "**Пример:**\n"
-        "Создайте отсчёт до дня рождения, отпуска, дедлайна и я буду каждый день напоминать сколько дней осталось!"
+        "Создайте отсчёт до дня рождения, отпуска, дедлайна и я буду напоминать сколько дней осталось - "
+        "каждый день или по своему расписанию, а ближе к дате и чаще!"
     )
     
     keyboard = ReplyKeyboardMarkup(
@@ -420,7 +2425,7 @@ async def process_target_date(message: types.Message, state: FSMContext):
     try:
         # Парсим дату
         target_date = datetime.strptime(message.text, "%d.%m.%Y").date()
-        today = datetime.now(tz).date()
+        today = clock.now().date()
         
         # Проверки
         if target_date <= today:
@@ -491,12 +2496,14 @@ async def process_time_selection(callback_query: types.CallbackQuery, state: FSM
         'target_date': data['target_date'],
         'notification_time': time_str,
         'chat_type': chat_type,
-        'message_thread_id': message_thread_id
+        'message_thread_id': message_thread_id,
+        'bot_id': callback_query.bot.id
     }
     
-    event_id = save_event(event_data)
+    event_id = await storage.save_event(event_data)
+    schedule_changed()
     
-    today = datetime.now(tz).date()
+    today = clock.now().date()
     days_left = days_until_target(data['target_date'], today)
     
     # Формируем ответ
@@ -548,14 +2555,16 @@ async def process_custom_time(message: types.Message, state: FSMContext):
             'target_date': data['target_date'],
             'notification_time': time_str,
             'chat_type': chat_type,
-            'message_thread_id': message_thread_id
+            'message_thread_id': message_thread_id,
+            'bot_id': message.bot.id
         }
         
         # Сохраняем в БД
-        event_id = save_event(event_data)
+        event_id = await storage.save_event(event_data)
+        schedule_changed()
         
         # Рассчитываем дни
-        today = datetime.now(tz).date()
+        today = clock.now().date()
         days_left = days_until_target(data['target_date'], today)
         
         success_message = (
@@ -583,7 +2592,7 @@ async def process_custom_time(message: types.Message, state: FSMContext):
 @dp.message(F.text == "📋 Все отсчёты")
 async def cmd_list(message: types.Message):
     """Показать все отсчёты в чате"""
-    chat_events = get_chat_events(message.chat.id)
+    chat_events = await storage.get_chat_events(message.chat.id, bot_id=message.bot.id)
     
     if not chat_events:
         await message.answer(
@@ -593,7 +2602,8 @@ async def cmd_list(message: types.Message):
         )
         return
     
-    events_list = format_events_list(chat_events)
+    schedules = await storage.get_event_schedules([e['id'] for e in chat_events])
+    events_list = format_events_list(chat_events, schedules)
     
     events_list += (
         "\n\n**Как управлять:**\n"
@@ -608,7 +2618,9 @@ async def cmd_list(message: types.Message):
 @dp.message(F.text == "👤 Мои отсчёты")
 async def cmd_my(message: types.Message):
     """Показать мои отсчёты в этом чате"""
-    user_events = get_user_events_in_chat(message.chat.id, message.from_user.id)
+    user_events = await storage.get_user_events_in_chat(
+        message.chat.id, message.from_user.id, bot_id=message.bot.id
+    )
     
     if not user_events:
         await message.answer(
@@ -618,7 +2630,8 @@ async def cmd_my(message: types.Message):
         )
         return
     
-    today = datetime.now(tz).date()
+    schedules = await storage.get_event_schedules([e['id'] for e in user_events])
+    today = clock.now().date()
     message_text = "**Ваши отсчёты в этом чате:**\n\n"
     
     for i, event in enumerate(user_events, 1):
@@ -633,7 +2646,7 @@ async def cmd_my(message: types.Message):
         
         message_text += f"{i}. **{event['event_name']}**\n"
         message_text += f"{event['target_date'].strftime('%d.%m.%Y')}\n"
-        message_text += f"Уведомления в {event['notification_time']}\n"
+        message_text += f"Уведомления: {describe_schedule(schedules[event['id']])}\n"
         message_text += f"Осталось: {days_left} {day_word}\n"
         message_text += f"`{event['id'][:8]}...`\n\n"
     
@@ -655,20 +2668,13 @@ async def cmd_delete(message: types.Message, state: FSMContext, command: Command
         event_id_short = command.args.strip()
         
         # Ищем полный ID
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''
-        SELECT id, event_name FROM events 
-        WHERE id LIKE ? AND user_id = ? AND chat_id = ?
-        ''', (f"{event_id_short}%", message.from_user.id, message.chat.id))
-        
-        result = cursor.fetchone()
-        conn.close()
+        event = await storage.find_user_event(
+            event_id_short, message.from_user.id, message.chat.id, bot_id=message.bot.id
+        )
         
-        if result:
-            event_id, event_name = result
-            delete_event(event_id, message.from_user.id)
-            await message.answer(f"Отсчёт \"{event_name}\" удалён!")
+        if event:
+            await storage.delete_event(event['id'], message.from_user.id)
+            await message.answer(f"Отсчёт \"{event['event_name']}\" удалён!")
         else:
             await message.answer(
                 "**Отсчёт не найден**\n\n"
@@ -682,7 +2688,9 @@ async def cmd_delete(message: types.Message, state: FSMContext, command: Command
         return
     
     # Если ID не передан, показываем список для выбора
-    user_events = get_user_events_in_chat(message.chat.id, message.from_user.id)
+    user_events = await storage.get_user_events_in_chat(
+        message.chat.id, message.from_user.id, bot_id=message.bot.id
+    )
     
     if not user_events:
         await message.answer(
@@ -724,21 +2732,16 @@ async def process_delete(callback_query: types.CallbackQuery):
     event_id = callback_query.data.replace("delete_", "")
     
     # Получаем информацию об отсчёте
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-    SELECT event_name FROM events 
-    WHERE id = ? AND user_id = ?
-    ''', (event_id, callback_query.from_user.id))
-    
-    result = cursor.fetchone()
+    event = await storage.find_user_event(
+        event_id, callback_query.from_user.id, callback_query.message.chat.id,
+        bot_id=callback_query.bot.id
+    )
     
-    if result:
-        event_name = result[0]
-        delete_event(event_id, callback_query.from_user.id)
+    if event:
+        await storage.delete_event(event['id'], callback_query.from_user.id)
         
         await callback_query.message.edit_text(
-            f"Отсчёт \"{event_name}\" удалён!",
+            f"Отсчёт \"{event['event_name']}\" удалён!",
             reply_markup=None
         )
     else:
@@ -748,9 +2751,48 @@ async def process_delete(callback_query: types.CallbackQuery):
             reply_markup=None
         )
     
-    conn.close()
     await callback_query.answer()
 
+@dp.message(Command("schedule"))
+async def cmd_schedule(message: types.Message, command: CommandObject):
+    """Настроить расписание уведомлений отсчёта"""
+    args = (command.args or "").split(maxsplit=1)
+    usage = (
+        "**Расписание уведомлений**\n\n"
+        "/schedule ID дни=будни время=09:00,18:00 за7=12:00,21:00\n\n"
+        "• *дни* - все, будни, выходные, пн-пт, пт-пн, пн,ср,пт\n"
+        "• *время* - одно или несколько значений ЧЧ:ММ\n"
+        "• *заN* - дополнительные уведомления, когда до события N дней и меньше "
+        "(*заN=нет* - убрать)\n\n"
+        "Посмотрите ID своих отсчётов командой /my"
+    )
+    if not args:
+        await message.answer(usage, parse_mode="Markdown")
+        return
+    
+    event = await storage.find_user_event(
+        args[0], message.from_user.id, message.chat.id, bot_id=message.bot.id
+    )
+    if not event:
+        await message.answer("Отсчёт не найден. Посмотрите ID своих отсчётов командой /my")
+        return
+    
+    schedule = await storage.get_event_schedule(event['id'])
+    if len(args) > 1:
+        try:
+            schedule = parse_schedule(args[1], schedule)
+        except ValueError:
+            await message.answer(usage, parse_mode="Markdown")
+            return
+        await storage.set_event_schedule(event['id'], schedule)
+        schedule_changed()
+    
+    await message.answer(
+        f"**{event['event_name']}**\n"
+        f"Уведомления: {describe_schedule(schedule)}",
+        parse_mode="Markdown"
+    )
+
 @dp.message(Command("help"))
 @dp.message(F.text == "ℹ️ Помощь")
 async def cmd_help(message: types.Message):
@@ -764,15 +2806,18 @@ async def cmd_help(message: types.Message):
         "• /list - все отсчёты в чате\n"
         "• /my - мои отсчёты в чате\n"
         "• /delete - удалить отсчёт\n"
+        "• /schedule - расписание уведомлений\n"
         "• /help - эта справка\n\n"
         
         "**Создание отсчёта:**\n"
         "1. Название события (до 100 символов)\n"
         "2. Дата события (ДД.ММ.ГГГГ)\n"
-        "3. Время ежедневных уведомлений\n\n"
+        "3. Время ежедневных уведомлений (потом его можно сменить в /schedule)\n\n"
         
         "**Как это работает:**\n"
-        "• Бот отправляет сообщение каждый день в указанное время\n"
+        "• Бот отправляет сообщение в указанное время - по умолчанию каждый день\n"
+        "• В /schedule можно выбрать дни недели, несколько уведомлений в день "
+        "и дополнительные уведомления ближе к событию\n"
         "• Сообщение содержит количество оставшихся дней\n"
         "• Когда событие наступает, отсчёт автоматически прекращается\n\n"
         
@@ -801,30 +2846,21 @@ async def cmd_help(message: types.Message):
 @dp.message(Command("stats"))
 async def cmd_stats(message: types.Message):
     """Статистика по чату (только для админов в группах)"""
-    chat_events = get_chat_events(message.chat.id)
+    today = clock.now().date()
+    stats = await storage.get_chat_stats(message.chat.id, today, bot_id=message.bot.id)
     
-    if not chat_events:
+    if not stats['total_events']:
         await message.answer("В этом чате нет активных отсчётов")
         return
     
-    # Статистика
-    today = datetime.now(tz).date()
-    total_events = len(chat_events)
-    upcoming_events = sum(1 for e in chat_events if e['target_date'] >= today)
-    
-    # Самые близкие события
-    closest_events = sorted(
-        [e for e in chat_events if e['target_date'] >= today],
-        key=lambda x: x['target_date']
-    )[:3]
-    
     stats_text = f"**Статистика чата**\n\n"
-    stats_text += f"• Всего отсчётов: {total_events}\n"
-    stats_text += f"• Активных: {upcoming_events}\n\n"
+    stats_text += f"• Всего отсчётов: {stats['total_events']}\n"
+    stats_text += f"• Активных: {stats['upcoming_events']}\n\n"
     
-    if closest_events:
+    # Самые близкие события
+    if stats['closest_events']:
         stats_text += "**Ближайшие события:**\n"
-        for event in closest_events:
+        for event in stats['closest_events']:
             days_left = days_until_target(event['target_date'], today)
             if days_left == 1:
                 day_word = "день"
@@ -836,80 +2872,1208 @@ async def cmd_stats(message: types.Message):
     
     await message.answer(stats_text, parse_mode="Markdown")
 
+def is_admin(user_id: int) -> bool:
+    """Проверить, является ли пользователь администратором бота"""
+    return user_id in ADMIN_IDS
+
+@dp.message(Command("adminstats"))
+async def cmd_admin_stats(message: types.Message):
+    """Глобальная статистика (только для администраторов бота)"""
+    if not is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администраторам бота")
+        return
+    
+    stats = await storage.get_global_stats()
+    
+    stats_text = "**Статистика бота**\n\n"
+    stats_text += f"• Активных отсчётов: {stats['active_events']}\n"
+    stats_text += f"• Чатов с отсчётами: {stats['active_chats']}\n"
+    if stats['active_chats']:
+        stats_text += f"• В среднем на чат: {stats['active_events'] / stats['active_chats']:.1f}\n"
+    
+    if stats['top_chats']:
+        stats_text += "\n**Чаты с наибольшим числом отсчётов:**\n"
+        for chat_id, count in stats['top_chats']:
+            stats_text += f"• `{chat_id}`: {count}\n"
+    
+    if stats['busiest_minutes']:
+        stats_text += "\n**Самые загруженные минуты:**\n"
+        for notification_time, count in stats['busiest_minutes']:
+            stats_text += f"• {notification_time}: {count}\n"
+    
+    if stats['sent_per_day']:
+        stats_text += "\n**Отправлено уведомлений по дням:**\n"
+        for notification_date, sent in stats['sent_per_day']:
+            stats_text += f"• {date.fromisoformat(notification_date).strftime('%d.%m.%Y')}: {sent}\n"
+    
+    stats_text += "\n**Исходящие запросы (ожидание и полное время, p50/p99, мс):**\n"
+    for name, metrics in outbound.stats().items():
+        stats_text += (
+            f"• {OUTBOUND_CLASS_NAMES[name]}: {metrics['count']}, в очереди {metrics['queued']}, "
+            f"ожидание {1000 * metrics['wait_p50']:.0f}/{1000 * metrics['wait_p99']:.0f}, "
+            f"всего {1000 * metrics['latency_p50']:.0f}/{1000 * metrics['latency_p99']:.0f}\n"
+        )
+    
+    batches = [stats for stats in batch_stats.values() if stats['done']][-5:]
+    if batches:
+        stats_text += (
+            "\n**Последние пачки уведомлений (отправлено из поставленных, ждут повтора, ошибки, "
+            "подготовка, запас, отправка, опоздание первого и последнего):**\n"
+        )
+        for stats in reversed(batches):
+            send_time, first, last = batch_timing(stats)
+            stats_text += (
+                f"• {datetime.fromtimestamp(stats['scheduled_at'], tz).strftime('%H:%M')}: "
+                f"{stats['sent']}/{stats['added']}, {stats['retrying']}, {stats['failed']}, "
+                f"{1000 * stats['staging']:.0f} мс, {stats['ahead']:.1f} с, {send_time:.1f} с, "
+                f"{first:.2f}/{last:.2f} с\n"
+            )
+    
+    await message.answer(stats_text, parse_mode="Markdown")
+
+# Дата последней очистки прошедших событий, изменения событий после подготовки
+# пачки и начало следующей подготовленной пачки (для пробуждения воркеров)
+scheduler_state = {'cleanup_date': None, 'changed': False, 'next_batch_at': None}
+
+# Замеры пачек уведомлений по минутам (ключ - scheduled_at), не больше суток
+BATCH_HISTORY = 24 * 60
+batch_stats: Dict[float, dict] = {}
+
+def schedule_changed():
+    """Отметить, что события изменились и подготовленную пачку нужно дополнить"""
+    scheduler_state['changed'] = True
+
+def note_staged(scheduled_at: float, due: int, added: int, duration: float):
+    """Записать подготовку пачки: сколько поставлено и за сколько до начала минуты"""
+    if not added:
+        return
+    stats = batch_stats.get(scheduled_at)
+    if stats is None:
+        stats = batch_stats[scheduled_at] = {
+            'scheduled_at': scheduled_at,
+            'due': due,
+            'added': 0,
+            'staging': 0.0,
+            # Отрицательный запас - пачка готовилась уже после начала минуты
+            'ahead': scheduled_at - clock.time(),
+            'sent': 0,
+            'failed': 0,
+            # Ждут повторной отправки; retry_ids - их id в outbox
+            'retrying': 0,
+            'retry_ids': set(),
+            'first_sent': None,
+            'last_sent': None,
+            'done': False
+        }
+        while len(batch_stats) > BATCH_HISTORY:
+            batch_stats.pop(next(iter(batch_stats)))
+    stats['added'] += added
+    stats['staging'] += duration
+
+def note_delivery(item: dict, delivered: bool):
+    """Учесть отправку уведомления в замерах его пачки"""
+    stats = batch_stats.get(item['scheduled_at'])
+    if stats is None:
+        return
+    
+    stats['retry_ids'].discard(item['id'])
+    stats['retrying'] = len(stats['retry_ids'])
+    if delivered:
+        stats['sent'] += 1
+        if stats['first_sent'] is None:
+            stats['first_sent'] = item['sent_at']
+        stats['last_sent'] = item['sent_at']
+    else:
+        stats['failed'] += 1
+    check_batch_done(stats)
+
+def note_retry(item: dict, status: Optional[str]):
+    """Учесть возврат уведомления в очередь.
+    
+    'failed' - попытки кончились; None - запись уже у другого воркера, её учтёт он.
+    """
+    if status is None:
+        return
+    if status == 'failed':
+        note_delivery(item, False)
+        return
+    stats = batch_stats.get(item['scheduled_at'])
+    if stats is None:
+        return
+    stats['retry_ids'].add(item['id'])
+    stats['retrying'] = len(stats['retry_ids'])
+    check_batch_done(stats)
+
+def check_batch_done(stats: dict):
+    """Пачка завершена, когда каждое уведомление отправлено, снято или ждёт повтора.
+    
+    Отчёт пишется в лог один раз; повторы, завершившиеся позже, обновляют
+    только счётчики пачки.
+    """
+    if stats['done'] or stats['sent'] + stats['failed'] + stats['retrying'] < stats['added']:
+        return
+    stats['done'] = True
+    logger.info(
+        "Пачка %s: отправлено %s из %s, ждут повтора %s, ошибок %s, подготовка %.0f мс "
+        "за %.1f с до начала, отправка %.1f с, опоздание первого %.2f с, последнего %.2f с",
+        datetime.fromtimestamp(stats['scheduled_at'], tz).strftime('%H:%M'),
+        stats['sent'], stats['added'], stats['retrying'], stats['failed'],
+        1000 * stats['staging'], stats['ahead'],
+        *batch_timing(stats),
+        extra={'batch': stats['scheduled_at']}
+    )
+
+def batch_timing(stats: dict) -> tuple:
+    """Длительность отправки пачки и опоздание первого и последнего сообщения, с"""
+    if not stats['sent']:
+        return 0.0, 0.0, 0.0
+    return (
+        stats['last_sent'] - stats['first_sent'],
+        stats['first_sent'] - stats['scheduled_at'],
+        stats['last_sent'] - stats['scheduled_at']
+    )
+
+async def scheduler_tick(
+    now: Optional[datetime] = None,
+    profile: Optional[cProfile.Profile] = None,
+    stages: Optional[Dict[str, float]] = None
+) -> int:
+    """Один проход планировщика.
+    
+    Отбирает события, у которых есть слот расписания на минуту now, и ставит
+    их в очередь outbox. Минута может быть и будущей: такие записи воркеры
+    получат только в её начале. Возвращает количество событий, подошедших по времени.
+    
+    profile включается только на рендер, в stages записывается время этапов TICK_STAGES.
+    """
+    started = time.perf_counter()
+    lap = started
+    if stages is None:
+        stages = {}
+    
+    def finish_stage(stage: str):
+        nonlocal lap
+        now_counter = time.perf_counter()
+        stages[stage] = now_counter - lap
+        lap = now_counter
+    
+    if now is None:
+        now = clock.now()
+    today = now.date()
+    minute_of_day = now.hour * 60 + now.minute
+    scheduled_at = now.replace(second=0, microsecond=0).timestamp()
+    
+    # Раз в сутки снимаем события, дата которых уже прошла (по текущей дате,
+    # а не по дате подготавливаемой минуты - иначе в 23:59 снимутся сегодняшние),
+    # и удаляем старые уведомления, снятые с доставки
+    current_date = clock.now().date()
+    if scheduler_state['cleanup_date'] != current_date:
+        await storage.deactivate_past_events(current_date)
+        purged = await storage.purge_outbox(clock.time() - OUTBOX_FAILED_KEEP_DAYS * 86400)
+        if purged:
+            logger.info("Удалено неотправленных уведомлений: %s", purged)
+        scheduler_state['cleanup_date'] = current_date
+    finish_stage('cleanup')
+    
+    events = await storage.get_due_events(now)
+    finish_stage('select')
+    
+    due = []
+    expired = []
+    if profile is not None:
+        profile.enable()
+    try:
+        for event in events:
+            days_left = days_until_target(event['target_date'], today)
+            
+            if days_left < 0:
+                expired.append(event['id'])
+                continue
+            
+            due.append({
+                'event_id': event['id'],
+                'notification_date': today,
+                'minute_of_day': minute_of_day,
+                'chat_id': event['chat_id'],
+                'chat_type': event['chat_type'],
+                'message_thread_id': event['message_thread_id'],
+                'bot_id': event['bot_id'],
+                'text': format_countdown_message(event['event_name'], days_left, event['target_date']),
+                'scheduled_at': scheduled_at,
+                # Если событие сегодня, деактивируем после последнего уведомления дня
+                'deactivate_after': days_left == 0 and event['last_slot']
+            })
+    finally:
+        if profile is not None:
+            profile.disable()
+    finish_stage('render')
+    
+    for event_id in expired:
+        await storage.deactivate_event(event_id)
+    # Уже отправленные и уже стоящие в очереди пропускаются при вставке
+    added = await storage.enqueue_notifications(due)
+    if added:
+        logger.info("В очередь поставлено уведомлений: %s", added)
+    finish_stage('enqueue')
+    note_staged(scheduled_at, len(due), added, time.perf_counter() - started)
+    
+    return len(due)
+
+@dp.message(Command("profile"))
+async def cmd_profile(message: types.Message, command: CommandObject):
+    """Профилирование (только для администраторов бота)"""
+    if not is_admin(message.from_user.id):
+        await message.answer("Команда доступна только администраторам бота")
+        return
+    
+    args = (command.args or "").split()
+    mode = args[0] if args else "ticks"
+    try:
+        amount = int(args[1]) if len(args) > 1 else None
+    except ValueError:
+        amount = None
+    
+    if mode == "ticks":
+        start_tick_profiling(amount or PROFILE_TICKS)
+        await message.answer(f"Профилирую следующие тики планировщика: {amount or PROFILE_TICKS}")
+    elif mode == "seconds":
+        if start_window_profiling(amount or PROFILE_SECONDS):
+            await message.answer(f"Профилирую обработку обновлений {amount or PROFILE_SECONDS} с")
+        else:
+            await message.answer("Профилирование уже запущено")
+    else:
+        await message.answer(
+            "Использование:\n"
+            "/profile ticks N - профилировать N тиков планировщика\n"
+            "/profile seconds N - профилировать N секунд работы бота\n\n"
+            f"Профили сохраняются в {PROFILE_DIR}"
+        )
+
 async def notification_scheduler():
-    """Фоновый планировщик уведомлений"""
+    """Фоновый планировщик уведомлений.
+    
+    Пачка каждой минуты выбирается, проверяется на дубли и рендерится заранее,
+    за SCHEDULER_STAGE_AHEAD секунд до начала минуты, поэтому воркеры доставки
+    начинают отправку ровно на её границе.
+    """
+    # Текущая минута при запуске ставится в очередь сразу
+    try:
+        await profiled_scheduler_tick()
+    except Exception as e:
+        logger.exception("Ошибка в планировщике: %s", e)
+    
     while True:
         try:
-            now = datetime.now(tz)
-            current_time = now.strftime("%H:%M")
-            today = now.date()
+            # Границы минут во всех часовых поясах совпадают с минутами UTC
+            boundary = (int(clock.time()) // 60 + 1) * 60
+            await clock.sleep(max(0.0, boundary - SCHEDULER_STAGE_AHEAD - clock.time()))
+            
+            scheduler_state['changed'] = False
+            scheduler_state['next_batch_at'] = boundary
+            await profiled_scheduler_tick(datetime.fromtimestamp(boundary, tz))
+            await clock.sleep(max(0.0, boundary - clock.time()))
             
-            # Получаем все активные события
-            all_events = get_all_active_events()
+            # Дополняем пачку событиями, созданными или изменёнными после подготовки;
+            # уже поставленные уведомления при вставке пропускаются
+            if scheduler_state['changed']:
+                scheduler_state['changed'] = False
+                await scheduler_tick(datetime.fromtimestamp(boundary, tz))
+            
+        except Exception as e:
+            logger.exception("Ошибка в планировщике: %s", e)
+            await clock.sleep(1)
+
+# Классы исходящих запросов в порядке приоритета
+OUTBOUND_CLASSES = ('interactive', 'bulk')
+OUTBOUND_CLASS_NAMES = {'interactive': "ответы", 'bulk': "рассылка"}
+# Методы, которые не расходуют лимит отправок
+UNSCHEDULED_METHODS = {'getUpdates', 'getMe'}
+
+# Запрос текущей задачи уже получил жетон планировщика
+outbound_scheduled: ContextVar[bool] = ContextVar('outbound_scheduled', default=False)
+
+class OutboundPaused(Exception):
+    """Бот на паузе после RetryAfter: рассылка не ждёт жетона, а откладывает отправку"""
+    
+    def __init__(self, bot_id: int, retry_after: float):
+        super().__init__(f"бот {bot_id} на паузе ещё {retry_after:.1f} с")
+        self.retry_after = retry_after
+
+class OutboundScheduler:
+    """Планировщик исходящих запросов к Bot API с классами приоритета.
+    
+    У каждого бота свой token bucket на rate запросов в секунду. Ожидающие
+    запросы получают жетоны строго по приоритету классов, а массовая рассылка
+    не забирает последние reserve жетонов - ответ пользователю уходит без
+    очереди даже посреди рассылки. RetryAfter останавливает все классы бота;
+    рассылка на паузе не ждёт, а получает OutboundPaused. С priorities=False все запросы стоят в одной очереди (для сравнения).
+    """
+    
+    def __init__(
+        self, rate: float, burst: Optional[float] = None,
+        reserve: float = OUTBOUND_INTERACTIVE_RESERVE, priorities: bool = True, window: int = 1000
+    ):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.reserve = reserve
+        self.priorities = priorities
+        self.lanes = {}
+        # Последние window замеров ожидания жетона и полного времени запроса
+        self.metrics = {
+            name: {'count': 0, 'wait': deque(maxlen=window), 'latency': deque(maxlen=window)}
+            for name in OUTBOUND_CLASSES
+        }
+    
+    def lane(self, bot_id: int) -> dict:
+        """Состояние бота: жетоны, очереди ожидающих по классам и задача выдачи"""
+        lane = self.lanes.get(bot_id)
+        if lane is None:
+            lane = self.lanes[bot_id] = {
+                'tokens': self.burst,
+                'updated': clock.time(),
+                'waiters': {name: deque() for name in OUTBOUND_CLASSES},
+                'pump': None
+            }
+        return lane
+    
+    def refill(self, lane: dict):
+        now = clock.time()
+        lane['tokens'] = min(self.burst, lane['tokens'] + (now - lane['updated']) * self.rate)
+        lane['updated'] = now
+    
+    def threshold(self, name: str) -> float:
+        """Сколько жетонов должно быть в корзине, чтобы запрос класса name прошёл"""
+        return 1 if name == OUTBOUND_CLASSES[0] else 1 + self.reserve
+    
+    def paused_for(self, bot_id: int) -> float:
+        """Сколько секунд осталось до конца паузы бота после RetryAfter"""
+        lane = self.lane(bot_id)
+        self.refill(lane)
+        return max(0.0, -lane['tokens'] / self.rate)
+    
+    def wait_estimate(self, bot_id: int, name: str) -> float:
+        """Оценка ожидания жетона для нового запроса класса name, с учётом очереди"""
+        lane = self.lane(bot_id)
+        self.refill(lane)
+        if not self.priorities:
+            name = OUTBOUND_CLASSES[0]
+        ahead = sum(len(lane['waiters'][other]) for other in OUTBOUND_CLASSES[:OUTBOUND_CLASSES.index(name) + 1])
+        return max(0.0, (self.threshold(name) + ahead - lane['tokens']) / self.rate)
+    
+    async def acquire(self, bot_id: int, name: str):
+        """Дождаться жетона на один запрос класса name"""
+        lane = self.lane(bot_id)
+        self.refill(lane)
+        if name != OUTBOUND_CLASSES[0] and lane['tokens'] < 0:
+            raise OutboundPaused(bot_id, -lane['tokens'] / self.rate)
+        if not self.priorities:
+            name = OUTBOUND_CLASSES[0]
+        
+        ahead = any(lane['waiters'][other] for other in OUTBOUND_CLASSES[:OUTBOUND_CLASSES.index(name) + 1])
+        if not ahead and lane['tokens'] >= self.threshold(name):
+            lane['tokens'] -= 1
+            return
+        
+        future = asyncio.get_running_loop().create_future()
+        lane['waiters'][name].append(future)
+        if lane['pump'] is None:
+            lane['pump'] = asyncio.create_task(self.pump(lane))
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Жетон уже выдан, но не использован - возвращаем
+            if future.done() and not future.cancelled():
+                lane['tokens'] += 1
+            raise
+    
+    async def pump(self, lane: dict):
+        """Выдавать жетоны ожидающим по мере пополнения корзины"""
+        while True:
+            self.refill(lane)
+            for waiters in lane['waiters'].values():
+                while waiters and waiters[0].done():
+                    waiters.popleft()
+            pending = [name for name in OUTBOUND_CLASSES if lane['waiters'][name]]
+            if not pending:
+                lane['pump'] = None
+                return
             
-            for event in all_events:
-                # Проверяем время
-                if event['notification_time'] == current_time:
-                    # Проверяем, не отправляли ли уже сегодня
-                    if was_notification_sent_today(event['id']):
-                        continue
-                    
-                    days_left = days_until_target(event['target_date'], today)
-                    
-                    if days_left < 0:
-                        deactivate_event(event['id'])
-                        continue
-                    
-                    # Формируем сообщение
-                    message = format_countdown_message(event['event_name'], days_left, event['target_date'])
-                    
-                    try:
-                        # Отправляем сообщение в зависимости от типа чата
-                        if event['chat_type'] in ['private', 'group', 'supergroup']:
-                            # Для топиков в супергруппах
-                            if event['message_thread_id']:
-                                await bot.send_message(
-                                    chat_id=event['chat_id'],
-                                    text=message,
-                                    message_thread_id=event['message_thread_id'],
-                                    parse_mode="Markdown"
-                                )
-                            else:
-                                await bot.send_message(
-                                    chat_id=event['chat_id'],
-                                    text=message,
-                                    parse_mode="Markdown"
-                                )
-                        
-                        # Отмечаем как отправленное
-                        mark_notification_sent(event['id'], today)
-                        
-                        # Если событие сегодня, деактивируем после отправки
-                        if days_left == 0:
-                            deactivate_event(event['id'])
-                    
-                    except Exception as e:
-                        logger.error(f"Ошибка отправки сообщения: {e}")
-                        # Если бот удален из чата, деактивируем событие
-                        if "chat not found" in str(e).lower() or "bot was blocked" in str(e).lower():
-                            deactivate_event(event['id'])
+            # Порог растёт с понижением приоритета, поэтому достаточно проверить старший класс
+            name = pending[0]
+            if lane['tokens'] >= self.threshold(name):
+                lane['tokens'] -= 1
+                lane['waiters'][name].popleft().set_result(None)
+                continue
+            # Не меньше 1 мс: на больших метках времени меньший шаг теряется в округлении
+            await clock.sleep(max((self.threshold(name) - lane['tokens']) / self.rate, 0.001))
+    
+    def pause(self, bot_id: int, seconds: float):
+        """Остановить отправки бота на seconds секунд (после RetryAfter).
+        
+        Ответы пользователям ждут конца паузы, ожидающие запросы рассылки
+        сразу получают OutboundPaused.
+        """
+        lane = self.lane(bot_id)
+        self.refill(lane)
+        lane['tokens'] = min(lane['tokens'], 0) - seconds * self.rate
+        for name in OUTBOUND_CLASSES[1:]:
+            for future in lane['waiters'][name]:
+                if not future.done():
+                    future.set_exception(OutboundPaused(bot_id, seconds))
+    
+    @asynccontextmanager
+    async def request(self, bot_id: int, name: str):
+        """Выполнить запрос класса name в пределах лимита бота и записать замеры"""
+        started = clock.time()
+        await self.acquire(bot_id, name)
+        granted = clock.time()
+        token = outbound_scheduled.set(True)
+        try:
+            yield
+        except TelegramRetryAfter as e:
+            self.pause(bot_id, e.retry_after)
+            raise
+        finally:
+            outbound_scheduled.reset(token)
+            metrics = self.metrics[name]
+            metrics['count'] += 1
+            metrics['wait'].append(granted - started)
+            metrics['latency'].append(clock.time() - started)
+    
+    def stats(self) -> dict:
+        """Замеры по классам: число запросов, очередь, p50/p99 ожидания и полного времени"""
+        result = {}
+        for name, metrics in self.metrics.items():
+            result[name] = {
+                'count': metrics['count'],
+                'queued': sum(len(lane['waiters'][name]) for lane in self.lanes.values()),
+                'wait_p50': percentile(metrics['wait'], 50),
+                'wait_p99': percentile(metrics['wait'], 99),
+                'latency_p50': percentile(metrics['latency'], 50),
+                'latency_p99': percentile(metrics['latency'], 99)
+            }
+        return result
+
+class OutboundMiddleware(BaseRequestMiddleware):
+    """Middleware сессии: запросы обработчиков идут через планировщик как интерактивные.
+    
+    Рассылка получает жетон сама (класс bulk), такие запросы пропускаются как есть.
+    """
+    
+    async def __call__(self, make_request, bot: Bot, method):
+        if outbound_scheduled.get() or method.__api_method__ in UNSCHEDULED_METHODS:
+            return await make_request(bot, method)
+        async with outbound.request(bot.id, 'interactive'):
+            return await make_request(bot, method)
+
+outbound = OutboundScheduler(BOT_RATE_LIMIT)
+bot_session.middleware(OutboundMiddleware())
+
+async def send_outbox_item(item: dict):
+    """Отправить одно уведомление из очереди от имени бота, создавшего событие"""
+    sender = bots.get(item['bot_id'])
+    if sender is None:
+        # Токен бота убран из конфигурации - повторять бессмысленно
+        raise LookupError(f"бот {item['bot_id']} не настроен")
+    
+    # Отправляем сообщение в зависимости от типа чата
+    if item['chat_type'] in ['private', 'group', 'supergroup']:
+        async with outbound.request(item['bot_id'], 'bulk'):
+            await sender.send_message(
+                chat_id=item['chat_id'],
+                text=item['text'],
+                # Для топиков в супергруппах
+                message_thread_id=item['message_thread_id'] or None,
+                parse_mode="Markdown"
+            )
+
+async def deliver_batch(batch: List[dict], worker_id: int = 0) -> List[dict]:
+    """Отправить захваченную пачку и подтвердить доставленные уведомления.
+    
+    Возвращает доставленные записи с отметкой времени отправки 'sent_at'.
+    
+    Отправка начинается, только если успеет закончиться до конца аренды:
+    ожидание жетона плюс HTTP_TIMEOUT на сам запрос. Если бот на паузе после
+    RetryAfter или аренды не хватает, записи этого бота возвращаются в очередь
+    без расхода попытки, а остальные боты пачки отправляются дальше.
+    """
+    delivered = []
+    # Боты, чьи записи откладываются, и время, когда их снова можно отправлять
+    resume_at = {}
+    for item in batch:
+        bot_id = item['bot_id']
+        if bot_id not in resume_at:
+            wait = outbound.wait_estimate(bot_id, 'bulk')
+            if clock.time() + wait + HTTP_TIMEOUT >= item['claimed_until']:
+                resume_at[bot_id] = clock.time() + wait
+        if bot_id in resume_at:
+            delay = max(resume_at[bot_id] - clock.time(), 0)
+            status = await storage.retry_outbox(item, f"отложено на {delay:.1f} с", delay=delay, count_attempt=False)
+            note_retry(item, status)
+            continue
+        
+        try:
+            await send_outbox_item(item)
+            item['sent_at'] = clock.time()
+            delivered.append(item)
+            note_delivery(item, True)
+        except (TelegramRetryAfter, OutboundPaused) as e:
+            # Telegram сам сообщает, сколько нужно подождать; ошибкой это не считается
+            resume_at[bot_id] = clock.time() + e.retry_after
+            status = await storage.retry_outbox(item, str(e), delay=e.retry_after, count_attempt=False)
+            note_retry(item, status)
+        except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError) as e:
+            logger.warning(
+                "Временная ошибка отправки (воркер %s): %s", worker_id, e,
+                extra={'event_id': item['event_id'], 'chat_id': item['chat_id'], 'bot_id': item['bot_id']}
+            )
+            status = await storage.retry_outbox(item, str(e))
+            note_retry(item, status)
+        except Exception as e:
+            logger.error(
+                "Ошибка отправки сообщения: %s", e,
+                extra={'event_id': item['event_id'], 'chat_id': item['chat_id'], 'bot_id': item['bot_id']}
+            )
+            # Если бот удален из чата, деактивируем событие
+            if "chat not found" in str(e).lower() or "bot was blocked" in str(e).lower():
+                await storage.deactivate_event(item['event_id'])
+            await storage.fail_outbox(item, str(e))
+            note_delivery(item, False)
+    
+    # Подтверждаем пачкой; при падении до подтверждения записи
+    # вернутся в очередь после истечения аренды (at-least-once)
+    await storage.ack_outbox(delivered)
+    return delivered
+
+async def delivery_worker(worker_id: int):
+    """Воркер доставки: забирает пачки из outbox, отправляет и подтверждает"""
+    while True:
+        try:
+            batch = await storage.claim_outbox_batch(OUTBOX_BATCH_SIZE)
+            if not batch:
+                # Просыпаемся ровно к началу подготовленной пачки
+                wait = 1.0
+                if scheduler_state['next_batch_at'] is not None:
+                    until_batch = scheduler_state['next_batch_at'] - clock.time()
+                    if 0 < until_batch < wait:
+                        wait = until_batch
+                await clock.sleep(wait)
+                continue
             
-            await asyncio.sleep(60)
+            await deliver_batch(batch, worker_id)
             
         except Exception as e:
-            logger.error(f"Ошибка в планировщике: {e}")
-            await asyncio.sleep(60)
+            logger.exception("Ошибка в воркере доставки %s: %s", worker_id, e)
+            await clock.sleep(1)
+
+# ========== ВОСПРОИЗВЕДЕНИЕ ДНЯ ==========
+
+class ReplayBot:
+    """Заглушка Bot для воспроизведения: не ходит в сеть, двигает виртуальное время"""
+    
+    def __init__(self, send_latency: float):
+        self.send_latency = send_latency
+        self.sent = 0
+    
+    async def send_message(self, **kwargs):
+        await clock.sleep(self.send_latency)
+        self.sent += 1
+
+def generate_events(count: int, start_date: date, seed: int = 0, bot_count: int = 1) -> List[dict]:
+    """Случайные события для воспроизведения и нагрузочных тестов.
+    
+    События раскладываются по ботам 0..bot_count-1 по очереди.
+    """
+    rnd = random.Random(seed)
+    # Большая часть пользователей выбирает время кнопками
+    preset_times = ["09:00", "12:00", "15:00", "18:00", "20:00"]
+    
+    events = []
+    for i in range(count):
+        if rnd.random() < 0.7:
+            notification_time = rnd.choice(preset_times)
+        else:
+            notification_time = f"{rnd.randrange(24):02d}:{rnd.randrange(60):02d}"
+        events.append({
+            'id': str(uuid.uuid4()),
+            'chat_id': rnd.randint(1, max(1, count // 3)),
+            'user_id': rnd.randint(1, max(1, count // 2)),
+            'event_name': f"Событие {i}",
+            'target_date': start_date + timedelta(days=rnd.randint(0, 5 * 365)),
+            'notification_time': notification_time,
+            'created_at': start_date.isoformat(),
+            'chat_type': rnd.choice(['private', 'private', 'group', 'supergroup']),
+            'message_thread_id': 0,
+            'bot_id': i % bot_count
+        })
+    return events
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль по отсортированной копии значений"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def run_replay(
+    start: datetime, hours: float, send_latency: float,
+    events: int = 0, seed: int = 0, bot_count: int = 1, prestage: bool = True
+) -> dict:
+    """Прогнать планировщик и доставку по виртуальным часам.
+    
+    Время двигается поминутно от start; отправки выполняет ReplayBot,
+    каждая из них сдвигает виртуальное время на send_latency секунд.
+    Тик планировщика блокирует цикл событий, поэтому сдвигает время на свою
+    реальную длительность. С prestage пачка минуты готовится, как в боте,
+    за SCHEDULER_STAGE_AHEAD секунд до её начала; без него - в начале минуты.
+    Сгенерированные боты 0..bot_count-1 и настроенные боты (для копии рабочей БД)
+    делят один ReplayBot, но лимиты отправок у них свои.
+    """
+    global clock, bot, bots, outbound
+    clock = VirtualClock(start)
+    bot = ReplayBot(send_latency)
+    bots = {bot_id: bot for bot_id in [*range(bot_count), *bots]}
+    outbound = OutboundScheduler(BOT_RATE_LIMIT)
+    batch_stats.clear()
+    
+    await storage.init()
+    if events:
+        await storage.insert_events(generate_events(events, start.date(), seed, bot_count))
+    
+    due_per_minute = {}
+    tick_durations = []
+    lateness = []
+    
+    async def stage(moment: datetime):
+        local_minute = moment.astimezone(tz)
+        tick_started = time.perf_counter()
+        due = await scheduler_tick(local_minute)
+        duration = time.perf_counter() - tick_started
+        tick_durations.append(duration)
+        clock.advance(duration)
+        if due:
+            due_per_minute[local_minute.strftime("%Y-%m-%d %H:%M %Z")] = due
+    
+    async def deliver(deadline: Optional[float] = None):
+        # До опустошения очереди или до deadline по виртуальным часам
+        while deadline is None or clock.time() < deadline:
+            batch = await storage.claim_outbox_batch(OUTBOX_BATCH_SIZE)
+            if not batch:
+                return
+            for item in await deliver_batch(batch):
+                lateness.append(item['sent_at'] - item['scheduled_at'])
+    
+    minute = start.astimezone(pytz.utc).replace(second=0, microsecond=0)
+    end = minute + timedelta(hours=hours)
+    if prestage:
+        clock.set(minute)
+        await stage(minute)
+    while minute < end:
+        # Если доставка не уложилась в минуту, часы уже ушли вперёд
+        if clock.time() < minute.timestamp():
+            clock.set(minute)
+        
+        if not prestage:
+            await stage(minute)
+            await deliver()
+        else:
+            next_minute = minute + timedelta(minutes=1)
+            stage_at = next_minute - timedelta(seconds=SCHEDULER_STAGE_AHEAD)
+            await deliver(stage_at.timestamp())
+            if clock.time() < stage_at.timestamp():
+                clock.set(stage_at)
+            if next_minute < end:
+                await stage(next_minute)
+            await deliver()
+        
+        minute += timedelta(minutes=1)
+    
+    await storage.close()
+    return {
+        'due_per_minute': due_per_minute,
+        'tick_durations': tick_durations,
+        'lateness': lateness,
+        'batches': [stats for stats in batch_stats.values() if stats['done']],
+        'sent': bot.sent
+    }
+
+def print_replay_report(report: dict):
+    """Вывести отчёт о воспроизведении"""
+    print("Уведомлений по минутам:")
+    for minute, due in report['due_per_minute'].items():
+        print(f"  {minute}  {due}")
+    
+    ticks = report['tick_durations']
+    print(f"\nТиков: {len(ticks)}")
+    print(
+        f"Длительность тика, мс: среднее {1000 * sum(ticks) / max(1, len(ticks)):.2f}, "
+        f"p99 {1000 * percentile(ticks, 99):.2f}, макс {1000 * max(ticks, default=0):.2f}"
+    )
+    
+    lateness = report['lateness']
+    print(f"\nОтправлено: {report['sent']}")
+    print(
+        f"Опоздание доставки, с: среднее {sum(lateness) / max(1, len(lateness)):.2f}, "
+        f"p99 {percentile(lateness, 99):.2f}, макс {max(lateness, default=0):.2f}"
+    )
+    
+    batches = sorted(report['batches'], key=lambda stats: stats['sent'], reverse=True)
+    if batches:
+        print("\nКрупнейшие пачки:")
+        print(
+            f"  {'минута':<8}{'отправлено':>11}{'подготовка, мс':>16}{'запас, с':>10}"
+            f"{'отправка, с':>13}{'первое, с':>11}{'последнее, с':>14}"
+        )
+        for stats in batches[:5]:
+            send_time, first, last = batch_timing(stats)
+            print(
+                f"  {datetime.fromtimestamp(stats['scheduled_at'], tz).strftime('%H:%M'):<8}{stats['sent']:>11}"
+                f"{1000 * stats['staging']:>16.1f}{stats['ahead']:>10.1f}"
+                f"{send_time:>13.2f}{first:>11.2f}{last:>14.2f}"
+            )
+        first_lateness = [batch_timing(stats)[1] for stats in batches]
+        print(
+            f"Опоздание первого сообщения пачки, с: среднее {sum(first_lateness) / len(first_lateness):.3f}, "
+            f"макс {max(first_lateness):.3f}"
+        )
 
 async def on_startup():
     """Действия при запуске"""
-    logger.info("Бот запущен!")
+    check_outbox_settings()
+    await storage.init(default_bot_id=bot.id)
+    logger.info("Бот запущен! Ботов в процессе: %s", len(bots))
+    
+    # Профилирование по сигналам
+    install_profiling_signals()
     
     # Запускаем планировщик уведомлений
     asyncio.create_task(notification_scheduler())
+    
+    # Запускаем воркеры доставки
+    for worker_id in range(OUTBOX_WORKERS):
+        asyncio.create_task(delivery_worker(worker_id))
 
 async def main():
     await on_startup()
-    await dp.start_polling(bot)
+    try:
+        # Один диспетчер опрашивает всех ботов
+        await dp.start_polling(*bots.values())
+    finally:
+        await storage.close()
+
+# ========== НАГРУЗОЧНЫЙ ТЕСТ HTTP ==========
+
+async def serve_fake_bot_api(port: int, latency: float):
+    """Фейковый Bot API на 127.0.0.1:port; работает, пока задачу не отменят.
+    
+    Сервер отвечает на sendMessage через latency секунд, на getUpdates -
+    пустым списком по истечении timeout, как long polling без обновлений.
+    """
+    async def get_me(request: web.Request) -> web.Response:
+        bot_id = int(request.match_info['token'].split(':')[0])
+        return web.json_response({
+            'ok': True,
+            'result': {'id': bot_id, 'is_bot': True, 'first_name': "Bench", 'username': f"bench{bot_id}_bot"}
+        })
+    
+    async def get_updates(request: web.Request) -> web.Response:
+        data = await request.post()
+        await asyncio.sleep(float(data.get('timeout', 0)))
+        return web.json_response({'ok': True, 'result': []})
+    
+    async def send_message(request: web.Request) -> web.Response:
+        if latency:
+            await asyncio.sleep(latency)
+        data = await request.post()
+        return web.json_response({
+            'ok': True,
+            'result': {
+                'message_id': 1,
+                'date': 0,
+                'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+                'text': data.get('text', '')
+            }
+        })
+    
+    app = web.Application()
+    app.router.add_post('/bot{token}/sendMessage', send_message)
+    app.router.add_post('/bot{token}/getMe', get_me)
+    app.router.add_post('/bot{token}/getUpdates', get_updates)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+def fake_bot_api_main(argv: List[str]):
+    """Фейковый Bot API отдельным процессом: python bot.py fake-bot-api --port 8089"""
+    parser = argparse.ArgumentParser(prog="bot.py fake-bot-api", description="Фейковый Bot API для нагрузочных тестов")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args(argv)
+    asyncio.run(serve_fake_bot_api(args.port, args.latency))
+
+def start_fake_bot_api(port: int, latency: float) -> subprocess.Popen:
+    """Запустить фейковый Bot API в отдельном процессе и дождаться, пока он начнёт принимать соединения.
+    
+    Отдельный процесс не делит GIL и цикл событий с измеряемым клиентом.
+    Остановка - terminate() у возвращённого процесса.
+    """
+    server = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'fake-bot-api', '--port', str(port), '--latency', str(latency)],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return server
+        except OSError:
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.kill()
+                raise RuntimeError(f"Фейковый Bot API не запустился на порту {port}")
+            time.sleep(0.1)
+
+async def bench_http_config(api_url: str, requests: int, concurrency: int, pool_size: int) -> dict:
+    """Отправить requests сообщений с concurrency параллельными запросами"""
+    bench_bot = Bot(token=API_TOKENS[0], session=create_bot_session(pool_size=pool_size, api_url=api_url))
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+    
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            started = time.perf_counter()
+            await bench_bot.send_message(chat_id=i, text="Тест")
+            latencies.append(time.perf_counter() - started)
+    
+    try:
+        # Прогрев пула соединений
+        await bench_bot.send_message(chat_id=0, text="Тест")
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    finally:
+        await bench_bot.session.close()
+    
+    return {
+        'rps': requests / elapsed,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99)
+    }
+
+def bench_http_main(argv: List[str]):
+    """Нагрузочный тест HTTP-клиента: python bot.py bench-http --pool-sizes 10,100"""
+    parser = argparse.ArgumentParser(prog="bot.py bench-http", description="Нагрузочный тест HTTP-клиента")
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    parser.add_argument('--pool-sizes', default="10,100", help="размеры пула через запятую")
+    parser.add_argument('--loops', default="asyncio,uvloop", help="циклы событий через запятую")
+    parser.add_argument('--latency', type=float, default=0.0, help="задержка ответа фейкового API, с")
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args(argv)
+    
+    api_url = f"http://127.0.0.1:{args.port}"
+    server = start_fake_bot_api(args.port, args.latency)
+    try:
+        print(f"{'цикл':<10}{'пул':>6}{'запр/с':>10}{'p50, мс':>10}{'p99, мс':>10}")
+        for loop_name in args.loops.split(','):
+            actual = install_event_loop(loop_name)
+            if actual != loop_name:
+                continue
+            for pool_size in (int(x) for x in args.pool_sizes.split(',')):
+                result = asyncio.run(bench_http_config(api_url, args.requests, args.concurrency, pool_size))
+                print(
+                    f"{actual:<10}{pool_size:>6}{result['rps']:>10.0f}"
+                    f"{1000 * result['p50']:>10.2f}{1000 * result['p99']:>10.2f}"
+                )
+        
+        install_event_loop('asyncio')
+    finally:
+        server.terminate()
+        server.wait()
+
+async def bench_outbound_config(
+    api_url: str, priorities: bool, bulk: int, interactive_rate: float, workers: int, rate: float
+) -> dict:
+    """Рассылка bulk сообщений воркерами и случайные ответы пользователям поверх неё"""
+    global outbound
+    outbound = OutboundScheduler(rate, priorities=priorities)
+    session = create_bot_session(api_url=api_url)
+    session.middleware(OutboundMiddleware())
+    bench_bot = Bot(token=API_TOKENS[0], session=session)
+    rnd = random.Random(0)
+    queue = asyncio.Queue()
+    for i in range(bulk):
+        queue.put_nowait(i)
+    
+    async def bulk_worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            async with outbound.request(bench_bot.id, 'bulk'):
+                await bench_bot.send_message(chat_id=i, text="Рассылка")
+    
+    async def interactive():
+        replies = []
+        while not queue.empty():
+            await asyncio.sleep(rnd.expovariate(interactive_rate))
+            replies.append(asyncio.create_task(bench_bot.send_message(chat_id=-1, text="Ответ")))
+        await asyncio.gather(*replies)
+    
+    try:
+        await asyncio.gather(interactive(), *(bulk_worker() for _ in range(workers)))
+    finally:
+        await session.close()
+    return outbound.stats()
+
+def bench_outbound_main(argv: List[str]):
+    """Ответы пользователям во время рассылки: python bot.py bench-outbound --bulk 1000"""
+    parser = argparse.ArgumentParser(
+        prog="bot.py bench-outbound", description="Задержка ответов во время рассылки: приоритеты и общая очередь"
+    )
+    parser.add_argument('--bulk', type=int, default=1000, help="сообщений в рассылке")
+    parser.add_argument('--interactive-rate', type=float, default=2, help="ответов пользователям в секунду")
+    parser.add_argument('--rate', type=float, default=BOT_RATE_LIMIT, help="лимит запросов бота в секунду")
+    parser.add_argument('--workers', type=int, default=OUTBOX_WORKERS)
+    parser.add_argument('--latency', type=float, default=0.03, help="задержка ответа фейкового API, с")
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args(argv)
+    
+    api_url = f"http://127.0.0.1:{args.port}"
+    server = start_fake_bot_api(args.port, args.latency)
+    try:
+        print(f"{'очередь':<12}{'класс':<12}{'запросов':>10}{'ожид. p50':>11}{'ожид. p99':>11}{'всего p50':>11}{'всего p99':>11}")
+        for priorities in (False, True):
+            stats = asyncio.run(bench_outbound_config(
+                api_url, priorities, args.bulk, args.interactive_rate, args.workers, args.rate
+            ))
+            for name, metrics in stats.items():
+                print(
+                    f"{'приоритеты' if priorities else 'общая':<12}{OUTBOUND_CLASS_NAMES[name]:<12}{metrics['count']:>10}"
+                    f"{1000 * metrics['wait_p50']:>11.1f}{1000 * metrics['wait_p99']:>11.1f}"
+                    f"{1000 * metrics['latency_p50']:>11.1f}{1000 * metrics['latency_p99']:>11.1f}"
+                )
+        print("Время в мс")
+    finally:
+        server.terminate()
+        server.wait()
+
+async def run_bots_polling(seconds: float):
+    """Опрашивать всех настроенных ботов seconds секунд"""
+    polling = asyncio.create_task(dp.start_polling(*bots.values(), handle_signals=False))
+    await asyncio.sleep(seconds)
+    await dp.stop_polling()
+    await polling
+
+def bench_bots_child(argv: List[str]):
+    """Замер в отдельном процессе: печатает пиковую память и процессорное время опроса"""
+    import resource
+    
+    # Время импорта и создания ботов в CPU не входит
+    cpu_started = time.process_time()
+    asyncio.run(run_bots_polling(float(argv[0])))
+    print(json.dumps({
+        'bots': len(bots),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'cpu': time.process_time() - cpu_started
+    }))
+
+def bench_bots_main(argv: List[str]):
+    """Стоимость дополнительного бота: python bot.py bench-bots --counts 1,10,100"""
+    parser = argparse.ArgumentParser(prog="bot.py bench-bots", description="Память и CPU на одного бота")
+    parser.add_argument('--counts', default="1,10,50,100", help="числа ботов через запятую")
+    parser.add_argument('--seconds', type=float, default=30, help="длительность опроса")
+    parser.add_argument('--port', type=int, default=8089)
+    args = parser.parse_args(argv)
+    
+    server = start_fake_bot_api(args.port, 0)
+    try:
+        
+        print(f"{'ботов':>6}{'RSS, МБ':>10}{'CPU опроса, с':>15}{'+RSS/бот, КБ':>15}{'+CPU/бот, мс':>15}")
+        base = None
+        for count in (int(x) for x in args.counts.split(',')):
+            # Каждый замер - в чистом процессе, чтобы не смешивать пиковую память
+            env = {
+                **os.environ,
+                'BOT_TOKENS': ",".join(f"{1000 + i}:bench" for i in range(count)),
+                'TELEGRAM_API_URL': f"http://127.0.0.1:{args.port}"
+            }
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), 'bench-bots-child', str(args.seconds)],
+                env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True, text=True
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+        
+            line = f"{result['bots']:>6}{result['max_rss_kb'] / 1024:>10.1f}{result['cpu']:>15.2f}"
+            if base is None:
+                base = result
+            elif result['bots'] > base['bots']:
+                extra = result['bots'] - base['bots']
+                line += (
+                    f"{(result['max_rss_kb'] - base['max_rss_kb']) / extra:>15.1f}"
+                    f"{1000 * (result['cpu'] - base['cpu']) / extra:>15.2f}"
+                )
+            print(line)
+    finally:
+        server.terminate()
+        server.wait()
+
+# ========== НАГРУЗОЧНЫЙ ТЕСТ ХРАНИЛИЩА ==========
+
+async def bench_storage(st: Storage, events: int, concurrency: int) -> List[tuple]:
+    """Пропускная способность основных операций хранилища. Возвращает (операция, оп/с)"""
+    results = []
+    start_date = clock.now().date()
+    
+    started = time.perf_counter()
+    await st.insert_events(generate_events(events, start_date, seed=1))
+    results.append(("insert_events (массовая вставка)", events / (time.perf_counter() - started)))
+    
+    writes = max(1, events // 20)
+    queue = asyncio.Queue()
+    for i in range(writes):
+        queue.put_nowait(i)
+    
+    async def writer():
+        while not queue.empty():
+            i = queue.get_nowait()
+            await st.save_event({
+                'chat_id': i,
+                'user_id': i,
+                'event_name': f"Запись {i}",
+                'target_date': start_date + timedelta(days=10),
+                'notification_time': "12:00"
+            })
+    
+    started = time.perf_counter()
+    await asyncio.gather(*(writer() for _ in range(concurrency)))
+    results.append((f"save_event ({concurrency} параллельно)", writes / (time.perf_counter() - started)))
+    
+    midnight = clock.now().replace(hour=0, minute=0)
+    started = time.perf_counter()
+    due_total = 0
+    for minute in range(24 * 60):
+        due_total += len(await st.get_due_events(midnight + timedelta(minutes=minute)))
+    results.append(("get_due_events (минут суток)", 24 * 60 / (time.perf_counter() - started)))
+    
+    busy_minute = midnight.replace(hour=9)
+    due = await st.get_due_events(busy_minute)
+    notifications = [
+        {
+            'event_id': e['id'],
+            'notification_date': busy_minute.date(),
+            'minute_of_day': 540,
+            'chat_id': e['chat_id'],
+            'text': "Тест",
+            'scheduled_at': busy_minute.timestamp()
+        }
+        for e in due
+    ]
+    started = time.perf_counter()
+    await st.enqueue_notifications(notifications)
+    delivered = 0
+    while True:
+        batch = await st.claim_outbox_batch(OUTBOX_BATCH_SIZE)
+        if not batch:
+            break
+        await st.ack_outbox(batch)
+        delivered += len(batch)
+    results.append(("outbox: постановка, захват, подтверждение", delivered / max(1e-9, time.perf_counter() - started)))
+    
+    started = time.perf_counter()
+    for chat_id in range(1, 501):
+        await st.get_chat_stats(chat_id, start_date)
+    results.append(("get_chat_stats", 500 / (time.perf_counter() - started)))
+    
+    return results
+
+async def run_storage_bench(st: Storage, events: int, concurrency: int) -> bool:
+    """Измерить хранилище и вывести отчёт"""
+    await st.init()
+    try:
+        if (await st.get_global_stats())['active_events']:
+            print("БД не пуста: нагрузочный тест рассчитан на чистую БД")
+            return False
+        
+        for name, rate in await bench_storage(st, events, concurrency):
+            print(f"{name:<45}{rate:>12.0f} оп/с")
+        return True
+    finally:
+        await st.close()
+
+def bench_storage_main(argv: List[str]):
+    """Нагрузочный тест хранилища: python bot.py bench-storage --backend postgres --dsn ..."""
+    global DB_FILE
+    parser = argparse.ArgumentParser(prog="bot.py bench-storage", description="Нагрузочный тест хранилища")
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db', help="новый файл БД SQLite")
+    parser.add_argument('--dsn', help="строка подключения к пустой БД PostgreSQL")
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args(argv)
+    
+    if args.backend == 'sqlite':
+        if not args.db or os.path.exists(args.db):
+            parser.error("укажите --db с путём к ещё не существующему файлу")
+        DB_FILE = args.db
+    elif not args.dsn:
+        parser.error("укажите --dsn")
+    
+    st = create_storage(args.backend, args.dsn)
+    if not asyncio.run(run_storage_bench(st, args.events, args.concurrency)):
+        sys.exit(1)
+
+def replay_main(argv: List[str]):
+    """Режим воспроизведения: python bot.py replay --start 2026-03-29T00:00 --db replay.db"""
+    global DB_FILE, storage
+    parser = argparse.ArgumentParser(prog="bot.py replay", description="Воспроизведение суток планировщика")
+    parser.add_argument('--start', required=True, help="начало в формате ISO, время по TIMEZONE")
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--backend', default='sqlite', choices=['sqlite', 'postgres'])
+    parser.add_argument('--db', help="файл БД SQLite для воспроизведения")
+    parser.add_argument('--dsn', help="строка подключения к отдельной БД PostgreSQL для воспроизведения")
+    parser.add_argument('--events', type=int, default=0, help="сколько случайных событий добавить в БД")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bots', type=int, default=1, help="по скольким ботам раскладывать события")
+    parser.add_argument('--no-prestage', action='store_true', help="готовить пачку в начале минуты, а не заранее")
+    parser.add_argument('--send-latency', type=float, default=0.035, help="время одной отправки, с")
+    args = parser.parse_args(argv)
+    
+    start = datetime.fromisoformat(args.start)
+    if start.tzinfo is None:
+        start = tz.localize(start)
+    
+    # Воспроизведение никогда не пишет в рабочую БД бота
+    if args.backend == 'sqlite' and not args.db or args.backend == 'postgres' and not args.dsn:
+        parser.error("укажите --db для sqlite или --dsn для postgres")
+    DB_FILE = args.db
+    storage = create_storage(args.backend, args.dsn)
+    
+    report = asyncio.run(run_replay(
+        start, args.hours, args.send_latency, args.events, args.seed, args.bots, not args.no_prestage
+    ))
+    print_replay_report(report)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "replay":
+        replay_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-http":
+        bench_http_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-storage":
+        bench_storage_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-outbound":
+        bench_outbound_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-bots":
+        bench_bots_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "fake-bot-api":
+        fake_bot_api_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "bench-bots-child":
+        bench_bots_child(sys.argv[2:])
+    else:
+        logger.info("Цикл событий: %s", install_event_loop())
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,71 @@
+import asyncio
+import inspect
+import os
+import sys
+from datetime import datetime
+
+import pytest
+
+# bot.py читает настройки при импорте и без токена не загружается
+os.environ.setdefault('BOT_TOKEN', '123:abc')
+os.environ.setdefault('TIMEZONE', 'Europe/Moscow')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+
+# Таблицы PostgreSQL, которые пересоздаются перед каждым тестом
+PG_TABLES = (
+    'events', 'event_slots', 'sent_notifications', 'outbox',
+    'stats_counters', 'chat_counters', 'minute_counters', 'daily_sent'
+)
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Асинхронные тесты выполняются в цикле фикстуры event_loop, если она нужна тесту"""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    args = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    loop = pyfuncitem.funcargs.get('event_loop')
+    if loop is None:
+        asyncio.run(pyfuncitem.obj(**args))
+    else:
+        loop.run_until_complete(pyfuncitem.obj(**args))
+    return True
+
+@pytest.fixture
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Виртуальные часы: понедельник 19.10.2026 09:00"""
+    virtual = bot.VirtualClock(bot.tz.localize(datetime(2026, 10, 19, 9, 0)))
+    monkeypatch.setattr(bot, 'clock', virtual)
+    return virtual
+
+async def reset_postgres(dsn: str):
+    import asyncpg
+    conn = await asyncpg.connect(dsn)
+    try:
+        await conn.execute(f"DROP TABLE IF EXISTS {', '.join(PG_TABLES)} CASCADE")
+    finally:
+        await conn.close()
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def storage(request, event_loop, clock, tmp_path, monkeypatch):
+    """Пустое хранилище; PostgreSQL проверяется, если задан TEST_DATABASE_URL"""
+    if request.param == 'sqlite':
+        monkeypatch.setattr(bot, 'DB_FILE', str(tmp_path / 'test.db'))
+        st = bot.create_storage('sqlite')
+    else:
+        dsn = os.getenv('TEST_DATABASE_URL')
+        if not dsn:
+            pytest.skip("TEST_DATABASE_URL не задан")
+        pytest.importorskip('asyncpg')
+        event_loop.run_until_complete(reset_postgres(dsn))
+        st = bot.create_storage('postgres', dsn)
+    event_loop.run_until_complete(st.init())
+    yield st
+    event_loop.run_until_complete(st.close())
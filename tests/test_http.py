@@ -0,0 +1,11 @@
+"""HTTP-сессия ботов"""
+import bot
+
+async def test_bot_session_pool_settings():
+    session = bot.create_bot_session(pool_size=7, pool_per_host=3, keepalive=5, dns_cache_ttl=60, timeout=10)
+    try:
+        client = await session.create_session()
+        assert client.connector.limit == 7
+        assert client.connector.limit_per_host == 3
+    finally:
+        await session.close()
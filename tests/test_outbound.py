@@ -0,0 +1,84 @@
+"""Планировщик исходящих запросов на виртуальных часах: время идёт только при ожидании жетона"""
+import asyncio
+
+import pytest
+
+from bot import OutboundPaused, OutboundScheduler
+
+BOT_ID = 1
+
+async def acquire_into(scheduler, name: str, granted: list):
+    """Дождаться жетона и записать класс запроса в порядке выдачи"""
+    await scheduler.acquire(BOT_ID, name)
+    granted.append(name)
+
+async def test_interactive_granted_before_queued_bulk(clock):
+    scheduler = OutboundScheduler(rate=1, burst=2, reserve=1)
+    for _ in range(2):
+        await scheduler.acquire(BOT_ID, 'interactive')
+    started = clock.time()
+    granted = []
+
+    # Рассылка встала в очередь первой, но ответ пользователю обгоняет её;
+    # затем рассылка копит жетон сверх резерва: 1 с + 2 с
+    await asyncio.gather(
+        acquire_into(scheduler, 'bulk', granted),
+        acquire_into(scheduler, 'interactive', granted)
+    )
+    assert granted == ['interactive', 'bulk']
+    assert clock.time() == started + 3
+
+async def test_bulk_leaves_reserve(clock):
+    scheduler = OutboundScheduler(rate=1, burst=5, reserve=2)
+    started = clock.time()
+
+    for _ in range(3):
+        await scheduler.acquire(BOT_ID, 'bulk')
+    assert clock.time() == started
+
+    await scheduler.acquire(BOT_ID, 'bulk')
+    assert clock.time() == started + 1
+
+    # Резерв достаётся ответам без ожидания
+    for _ in range(2):
+        await scheduler.acquire(BOT_ID, 'interactive')
+    assert clock.time() == started + 1
+
+async def test_pause_fails_bulk_and_delays_interactive(clock):
+    scheduler = OutboundScheduler(rate=1, burst=1, reserve=0)
+    await scheduler.acquire(BOT_ID, 'interactive')
+    started = clock.time()
+    bulk = asyncio.create_task(scheduler.acquire(BOT_ID, 'bulk'))
+    interactive = asyncio.create_task(scheduler.acquire(BOT_ID, 'interactive'))
+    await asyncio.sleep(0)
+
+    # Новая рассылка отказывает сразу, не уступая циклу, пока виртуальное время стоит
+    scheduler.pause(BOT_ID, 10)
+    with pytest.raises(OutboundPaused) as paused:
+        await scheduler.acquire(BOT_ID, 'bulk')
+    assert paused.value.retry_after == 10
+    assert clock.time() == started
+    with pytest.raises(OutboundPaused):
+        await bulk
+
+    await interactive
+    assert clock.time() == started + 11
+    assert scheduler.paused_for(BOT_ID) == 0
+
+async def test_token_refunded_on_cancel(clock):
+    scheduler = OutboundScheduler(rate=1, burst=1, reserve=0)
+    await scheduler.acquire(BOT_ID, 'interactive')
+    waiter = asyncio.create_task(scheduler.acquire(BOT_ID, 'interactive'))
+    await asyncio.sleep(0)
+    future = scheduler.lane(BOT_ID)['waiters']['interactive'][0]
+
+    # Отменяем задачу, когда жетон уже выдан, но она ещё не проснулась
+    while not future.done():
+        await asyncio.sleep(0)
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+
+    started = clock.time()
+    await scheduler.acquire(BOT_ID, 'interactive')
+    assert clock.time() == started
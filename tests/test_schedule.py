@@ -0,0 +1,75 @@
+"""Разбор расписания уведомлений и строки event_slots"""
+from datetime import date
+
+import pytest
+
+from bot import (
+    ALL_WEEKDAYS, ALWAYS_ACTIVE, MAX_SCHEDULE_SLOTS, WEEKENDS, WORKDAYS,
+    parse_schedule, parse_weekdays, schedule_slot_rows
+)
+
+DAILY = {'weekday_mask': ALL_WEEKDAYS, 'slots': [540], 'escalation': []}
+
+def days(*indexes: int) -> int:
+    return sum(1 << i for i in indexes)
+
+@pytest.mark.parametrize('spec, mask', [
+    ('все', ALL_WEEKDAYS),
+    ('будни', WORKDAYS),
+    ('выходные', WEEKENDS),
+    ('пн-пт', WORKDAYS),
+    ('ср-ср', days(2)),
+    ('пн,ср,пт', days(0, 2, 4)),
+    ('пн-вт,сб', days(0, 1, 5)),
+    ('пт-пн', days(4, 5, 6, 0)),
+    ('вс-вт', days(6, 0, 1)),
+])
+def test_parse_weekdays(spec, mask):
+    assert parse_weekdays(spec) == mask
+
+@pytest.mark.parametrize('spec', ['пн-', 'понедельник', 'пн-xx'])
+def test_parse_weekdays_rejects_unknown_days(spec):
+    with pytest.raises(ValueError):
+        parse_weekdays(spec)
+
+def test_parse_schedule():
+    schedule = parse_schedule("дни=пн-пт время=18:00,09:00 за7=12:00,21:00 за1=20:00", DAILY)
+    assert schedule == {
+        'weekday_mask': WORKDAYS,
+        'slots': [540, 1080],
+        'escalation': [(7, [720, 1260]), (1, [1200])]
+    }
+
+def test_parse_schedule_keeps_unspecified_parts():
+    current = {'weekday_mask': WEEKENDS, 'slots': [600], 'escalation': [(7, [1260])]}
+    assert parse_schedule("за3=20:00", current) == {
+        'weekday_mask': WEEKENDS,
+        'slots': [600],
+        'escalation': [(7, [1260]), (3, [1200])]
+    }
+
+def test_parse_schedule_removes_escalation():
+    current = {'weekday_mask': ALL_WEEKDAYS, 'slots': [540], 'escalation': [(7, [1260]), (1, [1200])]}
+    assert parse_schedule("за7=нет", current)['escalation'] == [(1, [1200])]
+    assert parse_schedule("за30=нет", current)['escalation'] == current['escalation']
+
+def test_parse_schedule_slot_limit():
+    regular = ','.join(f"{hour:02d}:00" for hour in range(MAX_SCHEDULE_SLOTS - 1))
+    assert len(parse_schedule(f"время={regular} за1=23:30", DAILY)['slots']) == MAX_SCHEDULE_SLOTS - 1
+    with pytest.raises(ValueError):
+        parse_schedule(f"время={regular} за1=23:30,23:45", DAILY)
+
+@pytest.mark.parametrize('spec', ['дни', 'время=', 'время=25:00', 'дни=пн-xx', 'часы=09:00', 'заN=12:00'])
+def test_parse_schedule_rejects_invalid(spec):
+    with pytest.raises(ValueError):
+        parse_schedule(spec, DAILY)
+
+def test_schedule_slot_rows():
+    schedule = {'weekday_mask': WORKDAYS, 'slots': [540, 1080], 'escalation': [(7, [1260]), (1, [720])]}
+    rows = schedule_slot_rows('e1', date(2026, 11, 10), schedule)
+    assert rows == [
+        (540, 'e1', None, ALWAYS_ACTIVE, WORKDAYS),
+        (1080, 'e1', None, ALWAYS_ACTIVE, WORKDAYS),
+        (1260, 'e1', 7, date(2026, 11, 3), WORKDAYS),
+        (720, 'e1', 1, date(2026, 11, 9), WORKDAYS),
+    ]
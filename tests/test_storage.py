@@ -0,0 +1,225 @@
+"""Общие проверки поведения хранилища: SQLite и PostgreSQL (при заданном TEST_DATABASE_URL)"""
+from datetime import date, timedelta
+
+import bot
+from bot import ALL_WEEKDAYS, WEEKENDS
+
+ESCALATING = {'weekday_mask': ALL_WEEKDAYS, 'slots': [540], 'escalation': [(7, [1260])]}
+
+def make_event(clock, days: int = 3, **fields) -> dict:
+    event = {
+        'chat_id': 100,
+        'user_id': 1,
+        'event_name': "Отпуск",
+        'target_date': clock.now().date() + timedelta(days=days),
+        'notification_time': "09:00",
+        'chat_type': 'private'
+    }
+    event.update(fields)
+    return event
+
+def make_notification(clock, event_id: str, **fields) -> dict:
+    notification = {
+        'event_id': event_id,
+        'notification_date': clock.now().date(),
+        'minute_of_day': 540,
+        'chat_id': 100,
+        'text': "Тест",
+        'scheduled_at': clock.time(),
+        'deactivate_after': False
+    }
+    notification.update(fields)
+    return notification
+
+async def save_pair(storage, clock):
+    """Отпуск через 3 дня и дедлайн через 30 дней в одном чате"""
+    event_id = await storage.save_event(make_event(clock))
+    far_id = await storage.save_event(make_event(clock, days=30, event_name="Дедлайн"))
+    return event_id, far_id
+
+async def claim_pair(storage, clock):
+    """Поставить оба события в очередь и захватить их; дедлайн деактивируется после отправки"""
+    event_id, far_id = await save_pair(storage, clock)
+    await storage.enqueue_notifications([
+        make_notification(clock, event_id),
+        make_notification(clock, far_id, deactivate_after=True)
+    ])
+    batch = await storage.claim_outbox_batch(10)
+    first, second = sorted(batch, key=lambda item: item['event_id'] != event_id)
+    return event_id, far_id, first, second
+
+def ids(events) -> list:
+    return [e['id'] for e in events]
+
+async def test_chat_events(storage, clock):
+    event_id, far_id = await save_pair(storage, clock)
+
+    chat_events = await storage.get_chat_events(100)
+    assert ids(chat_events) == [event_id, far_id]
+    assert isinstance(chat_events[0]['target_date'], date)
+    assert len(await storage.get_user_events_in_chat(100, 1)) == 2
+    assert not await storage.get_user_events_in_chat(100, 2)
+
+async def test_find_user_event_by_prefix(storage, clock):
+    event_id, _ = await save_pair(storage, clock)
+
+    assert (await storage.find_user_event(event_id[:8], 1, 100))['id'] == event_id
+    assert await storage.find_user_event(event_id[:8], 2, 100) is None
+
+async def test_due_events_single_slot(storage, clock):
+    event_id, far_id = await save_pair(storage, clock)
+
+    due = await storage.get_due_events(clock.now())
+    assert set(ids(due)) == {event_id, far_id}
+    assert all(e['last_slot'] for e in due)
+    assert not await storage.get_due_events(clock.now() + timedelta(minutes=1))
+
+async def test_event_schedule_weekday_mask(storage, clock):
+    event_id, _ = await save_pair(storage, clock)
+    schedule = {'weekday_mask': WEEKENDS, 'slots': [540], 'escalation': [(7, [1260])]}
+
+    await storage.set_event_schedule(event_id, schedule)
+    assert await storage.get_event_schedule(event_id) == schedule
+    assert event_id not in ids(await storage.get_due_events(clock.now()))
+
+async def test_escalation_slots(storage, clock):
+    event_id, far_id = await save_pair(storage, clock)
+    await storage.set_event_schedule(event_id, ESCALATING)
+    await storage.set_event_schedule(far_id, ESCALATING)
+    evening = clock.now().replace(hour=21)
+
+    assert set(ids(await storage.get_due_events(evening))) == {event_id}
+    due = {e['id']: e for e in await storage.get_due_events(clock.now())}
+    assert not due[event_id]['last_slot']
+    assert far_id not in ids(await storage.get_due_events(evening + timedelta(days=22)))
+    assert far_id in ids(await storage.get_due_events(evening + timedelta(days=23)))
+
+async def test_get_event_schedules(storage, clock):
+    event_id, far_id = await save_pair(storage, clock)
+    await storage.set_event_schedule(far_id, ESCALATING)
+
+    schedules = await storage.get_event_schedules([event_id, far_id])
+    assert set(schedules) == {event_id, far_id}
+    assert schedules[far_id] == ESCALATING
+
+async def test_enqueue_and_claim(storage, clock):
+    event_id, far_id = await save_pair(storage, clock)
+    notifications = [make_notification(clock, event_id), make_notification(clock, far_id)]
+
+    assert await storage.enqueue_notifications(notifications) == 2
+    assert await storage.enqueue_notifications(notifications) == 0
+    batch = await storage.claim_outbox_batch(10)
+    assert len(batch) == 2
+    assert all(item['claimed_until'] == clock.time() + bot.OUTBOX_LEASE_SECONDS for item in batch)
+    assert not await storage.claim_outbox_batch(10)
+
+async def test_retry_outbox(storage, clock):
+    _, _, first, _ = await claim_pair(storage, clock)
+
+    assert await storage.retry_outbox(first, "timeout", delay=0) == 'pending'
+    retried = await storage.claim_outbox_batch(10)
+    assert ids(retried) == [first['id']]
+
+    await storage.retry_outbox(retried[0], "пауза", delay=0, count_attempt=False)
+    retried = await storage.claim_outbox_batch(10)
+    assert [item['attempts'] for item in retried] == [1]
+
+async def test_stale_claim_token(storage, clock):
+    event_id, _, stale, _ = await claim_pair(storage, clock)
+    await storage.retry_outbox(stale, "пауза", delay=0, count_attempt=False)
+    fresh = (await storage.claim_outbox_batch(10))[0]
+
+    assert await storage.retry_outbox(stale, "поздно", delay=0) is None
+    await storage.fail_outbox(stale, "поздно")
+    await storage.ack_outbox([stale])
+    assert not await storage.was_notification_sent_today(event_id)
+    assert await storage.retry_outbox(fresh, "пауза", delay=0, count_attempt=False) == 'pending'
+
+async def test_fail_and_purge(storage, clock):
+    _, _, first, _ = await claim_pair(storage, clock)
+
+    await storage.fail_outbox(first, "forbidden")
+    await storage.retry_outbox(first, "поздно", delay=0)
+    assert not await storage.claim_outbox_batch(10)
+    assert await storage.purge_outbox(clock.time() - 1) == 0
+    assert await storage.purge_outbox(clock.time() + 1) == 1
+
+async def test_ack_outbox(storage, clock):
+    event_id, far_id, _, second = await claim_pair(storage, clock)
+
+    await storage.ack_outbox([second])
+    assert await storage.was_notification_sent_today(far_id)
+    assert not await storage.was_notification_sent_today(event_id)
+    assert await storage.enqueue_notifications([make_notification(clock, far_id)]) == 0
+    assert ids(await storage.get_chat_events(100)) == [event_id]
+
+async def test_mark_notification_sent(storage, clock):
+    event_id, _ = await save_pair(storage, clock)
+
+    await storage.mark_notification_sent(event_id, clock.now().date(), 1260)
+    assert await storage.was_notification_sent_today(event_id)
+
+async def test_stats(storage, clock):
+    today = clock.now().date()
+    event_id, _, _, second = await claim_pair(storage, clock)
+    await storage.set_event_schedule(event_id, ESCALATING)
+    await storage.ack_outbox([second])
+    await storage.mark_notification_sent(event_id, today, 1260)
+
+    stats = await storage.get_chat_stats(100, today)
+    assert stats['total_events'] == 1 and stats['upcoming_events'] == 1
+    assert [e['event_name'] for e in stats['closest_events']] == ["Отпуск"]
+    global_stats = await storage.get_global_stats()
+    assert global_stats['active_events'] == 1 and global_stats['active_chats'] == 1
+    assert global_stats['sent_per_day'] == [(today.isoformat(), 2)]
+    assert dict(global_stats['busiest_minutes']) == {"09:00": 1, "21:00": 1}
+
+async def test_delete_event(storage, clock):
+    event_id = await storage.save_event(make_event(clock))
+
+    await storage.delete_event(event_id, user_id=2)
+    assert len(await storage.get_chat_events(100)) == 1
+    await storage.delete_event(event_id, user_id=1)
+    assert not await storage.get_chat_events(100)
+    assert (await storage.get_global_stats())['active_events'] == 0
+
+async def test_deactivate_past_events(storage, clock):
+    past_id = await storage.save_event(make_event(clock, days=-1))
+
+    assert await storage.deactivate_past_events(clock.now().date()) == 1
+    assert await storage.find_user_event(past_id, 1, 100) is None
+
+async def test_bots_isolated(storage, clock):
+    today = clock.now().date()
+    first_id = await storage.save_event(make_event(clock, bot_id=1))
+    second_id = await storage.save_event(make_event(clock, bot_id=2))
+
+    assert ids(await storage.get_chat_events(100, bot_id=1)) == [first_id]
+    assert len(await storage.get_chat_events(100)) == 2
+    assert len(await storage.get_user_events_in_chat(100, 1, bot_id=2)) == 1
+    assert await storage.find_user_event(first_id, 1, 100, bot_id=2) is None
+    assert (await storage.get_chat_stats(100, today, bot_id=2))['total_events'] == 1
+
+    due = {e['id']: e['bot_id'] for e in await storage.get_due_events(clock.now())}
+    assert due == {first_id: 1, second_id: 2}
+    await storage.enqueue_notifications([
+        make_notification(clock, e_id, bot_id=bot_id) for e_id, bot_id in due.items()
+    ])
+    batch = await storage.claim_outbox_batch(10)
+    assert {item['event_id']: item['bot_id'] for item in batch} == due
+
+async def test_prestaged_batch(storage, clock):
+    kept_id, rescheduled_id, deactivated_id = [
+        await storage.save_event(make_event(clock)) for _ in range(3)
+    ]
+    staged = [
+        make_notification(clock, e_id, minute_of_day=541, scheduled_at=clock.time() + 60)
+        for e_id in (kept_id, rescheduled_id, deactivated_id)
+    ]
+
+    assert await storage.enqueue_notifications(staged) == 3
+    assert not await storage.claim_outbox_batch(10)
+    await storage.set_event_schedule(rescheduled_id, {'weekday_mask': ALL_WEEKDAYS, 'slots': [600], 'escalation': []})
+    await storage.deactivate_event(deactivated_id)
+    clock.advance(60)
+    assert [item['event_id'] for item in await storage.claim_outbox_batch(10)] == [kept_id]